@@ -8,43 +8,131 @@
 # - Controllo incrociato triplo (Busta + Cartellino + Agenda)
 # ==============================================================================
 
+import time
+
+STARTUP_T0 = time.perf_counter()  # Tempi di avvio dello script (report in sidebar)
+
 import sys
 import asyncio
 import re
 import os
+import subprocess
+import importlib
+import importlib.metadata
 import streamlit as st
-import google.generativeai as genai
-from playwright.sync_api import sync_playwright
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
-import time
+import base64
 import calendar
 import locale
+import hashlib
+import copy
+import io
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager
+from collections import deque
+from statistics import median
 from pathlib import Path
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, quote
 
-# --- OPTIONAL: DeepSeek + PDF extraction ---
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
-
-try:
-    import fitz  # PyMuPDF
-except Exception:
-    fitz = None
-
-try:
-    from pypdf import PdfReader
-except Exception:
-    PdfReader = None
+# SDK pesanti (google.generativeai, playwright, openai, fitz, pypdf): import
+# differiti al primo uso, vedi lazy_import
+IMPORT_BUDGET = float(st.secrets.get("IMPORT_BUDGET", 1.0))  # Secondi per gli import eager
+# Pacchetti senza cui l'app funziona in modo ridotto (lazy_import ritorna None);
+# per gli altri (google.generativeai, playwright) un import fallito è un errore
+OPTIONAL_IMPORTS = {"openai", "httpx", "fitz", "pypdf", "cryptography", "requests"}
 
+STARTUP_TIMINGS = {"import moduli": time.perf_counter() - STARTUP_T0}
 
 
 # ==============================================================================
 # CONFIG
 # ==============================================================================
 st.set_page_config(page_title="Gottardo Payroll", page_icon="💶", layout="wide")
-os.system("playwright install chromium")
+
+
+@st.cache_resource
+def get_import_timings():
+    """Secondi spesi da ogni import differito, per l'intero processo."""
+    return {}
+
+
+def lazy_import(module, attr=None):
+    """
+    Importa `module` al primo uso (poi è in sys.modules) e ne ritorna il modulo
+    o l'attributo `attr`. None se un pacchetto di OPTIONAL_IMPORTS non è
+    installato; per gli SDK obbligatori l'ImportError arriva al chiamante.
+    """
+    optional = module.split(".")[0] in OPTIONAL_IMPORTS
+    cached = module in sys.modules
+    t0 = time.perf_counter()
+    try:
+        mod = importlib.import_module(module)
+    except Exception:
+        if not optional:
+            raise
+        return None
+    if not cached:
+        get_import_timings()[module] = time.perf_counter() - t0
+    if not attr:
+        return mod
+    return getattr(mod, attr, None) if optional else getattr(mod, attr)
+
+
+CHROMIUM_MARKER = Path(".chromium_installed")  # Versione Playwright già provvista
+
+
+def _playwright_version():
+    try:
+        return importlib.metadata.version("playwright")
+    except Exception:
+        return "?"
+
+
+def install_chromium():
+    """
+    Esegue `playwright install chromium` e aggiorna il marker. Non è in
+    cache: il percorso di reinstallazione forzata deve poterla ripetere.
+    Solleva RuntimeError se l'installazione fallisce.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-m", "playwright", "install", "chromium"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(
+            (proc.stderr or proc.stdout or "").strip()[-500:]
+            or f"playwright install: codice {proc.returncode}"
+        )
+    CHROMIUM_MARKER.write_text(_playwright_version())
+
+
+@st.cache_resource
+def ensure_chromium():
+    """
+    Scarica Chromium per Playwright una sola volta per versione: il file
+    marker evita il sottoprocesso a ogni avvio, la cache a ogni rerun.
+    Un'installazione fallita solleva RuntimeError, che cache_resource non
+    memorizza: il rerun successivo ritenta.
+    """
+    t0 = time.perf_counter()
+    if CHROMIUM_MARKER.exists():
+        if CHROMIUM_MARKER.read_text().strip() == _playwright_version():
+            return {"esito": "saltato", "secondi": time.perf_counter() - t0}
+    install_chromium()
+    return {"esito": "installato", "secondi": time.perf_counter() - t0}
+
+
+_t0 = time.perf_counter()
+try:
+    CHROMIUM_SETUP = ensure_chromium()
+except Exception as e:
+    CHROMIUM_SETUP = {"esito": "errore", "errore": str(e), "secondi": time.perf_counter() - _t0}
+STARTUP_TIMINGS["chromium (verifica)"] = time.perf_counter() - _t0
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
@@ -70,6 +158,49 @@ MESI_IT = [
     "Dicembre",
 ]
 
+# Portale self-service
+PORTAL_URL = "https://selfservice.gottardospa.it/js_rev/JSipert2"
+SESSION_DIR = Path(".sessions")  # storage_state (cookie) per utente
+SESSION_IDLE_TTL = 20 * 60  # Secondi prima di chiudere un contesto inutilizzato
+# Rami paralleli (1 = seriale): ogni corsia attiva tiene un Chromium in memoria
+BROWSER_LANES = int(st.secrets.get("BROWSER_LANES", 2))
+# Corsia per ramo (modulo BROWSER_LANES): con 2 corsie i due download PDF,
+# i rami lenti, restano separati e l'agenda (cache/API) si accoda alla busta
+BRANCH_LANES = {"busta": 0, "cart": 1, "agenda": 2}
+RESOURCE_PROFILE = st.secrets.get("RESOURCE_PROFILE", "lean")  # "full" = carica tutto
+AI_WORKERS = int(st.secrets.get("AI_WORKERS", 4))  # Analisi AI contemporanee (processo)
+# Hedging: secondi prima di lanciare anche il modello successivo (None = spento)
+AI_HEDGE_DELAY = st.secrets.get("AI_HEDGE_DELAY")
+AI_HEDGE_DELAY = float(AI_HEDGE_DELAY) if AI_HEDGE_DELAY is not None else None
+AI_HEDGE_FANOUT = int(st.secrets.get("AI_HEDGE_FANOUT", 2))  # Modelli in parallelo
+AI_CONNECT_TIMEOUT = 10  # Secondi per aprire la connessione alle API AI
+AI_READ_TIMEOUT = float(st.secrets.get("AI_READ_TIMEOUT", 90))  # Secondi per la risposta
+
+# Catalogo modelli Gemini salvato su disco (niente list_models a ogni avvio)
+MODEL_CATALOG_FILE = Path(".model_catalog.json")
+MODEL_CATALOG_TTL = 24 * 3600  # Secondi
+
+# Cache risultati AI (chiave: SHA-256 del PDF + versione prompt/schema)
+# Le voci (netto, lordo, IRPEF...) sono cifrate con una chiave derivata dai
+# byte del PDF: le legge solo chi ha lo stesso documento. Senza cryptography
+# la cache su disco è spenta, come l'archivio documenti
+AI_CACHE_DIR = Path(".ai_cache")
+AI_CACHE_MAX_AGE = 365 * 24 * 3600  # Secondi
+AI_CACHE_MAX_BYTES = 20 * 1024 * 1024
+AI_SCHEMA_VERSION = 2  # Incrementare se cambia la struttura del JSON estratto
+
+# Testo per il fallback DeepSeek: righe compattate entro un budget di token
+DEEPSEEK_TOKEN_BUDGET = int(st.secrets.get("DEEPSEEK_TOKEN_BUDGET", 6000))
+CHARS_PER_TOKEN = 3.5  # Stima prudente per testo italiano pieno di numeri
+
+# Archivio locale dei PDF scaricati (cifrato, per utente; richiede cryptography)
+ARCHIVE_DIR = Path(".archive")
+ARCHIVE_RETENTION_DAYS = int(st.secrets.get("ARCHIVE_RETENTION_DAYS", 3 * 365))  # 0 = spento
+ARCHIVE_KDF_ITERATIONS = 390_000  # PBKDF2-SHA256 password -> chiave Fernet
+# Il cartellino non ha link di catalogo: a mese chiuso si riverifica dopo questo
+# intervallo, per cogliere le correzioni delle presenze (confronto SHA-256)
+ARCHIVE_CART_RECHECK = int(st.secrets.get("ARCHIVE_CART_RECHECK", 24 * 3600))
+
 # Codici eventi calendario Gottardo (dallo screenshot del portale)
 CALENDAR_CODES = {
     "FEP": "FERIE PIANIFICATE",  # 🟡 Giallo
@@ -79,6 +210,22 @@ CALENDAR_CODES = {
     "MAL": "MALATTIA",  # 🔵 Azzurro
 }
 
+# Codici API -> chiavi normalizzate (coerenti con il resto del codice)
+AGENDA_CODE_KEYS = {
+    "FEP": "FERIE",
+    "OMT": "OMESSA TIMBRATURA",
+    "RCS": "RIPOSO",
+    "RIC": "RIPOSO",
+    "MAL": "MALATTIA",
+}
+
+# Cache annuale eventi agenda (per utente e anno, in memoria)
+AGENDA_YEAR_TTL = int(st.secrets.get("AGENDA_YEAR_TTL", 12 * 3600))  # Mesi chiusi
+AGENDA_CURRENT_TTL = int(st.secrets.get("AGENDA_CURRENT_TTL", 10 * 60))  # Mese in corso
+
+# Catalogo documenti (link del tab Documenti) per utente
+DOC_CATALOG_TTL = 30 * 60  # Secondi
+
 # Keywords per riconoscere eventi nell'agenda (DOM parsing)
 AGENDA_KEYWORDS = [
     "OMESSA TIMBRATURA",
@@ -100,6 +247,74 @@ AGENDA_KEYWORDS = [
 
 
 
+# ==============================================================================
+# AVANZAMENTO DAI THREAD DI LAVORO
+# ==============================================================================
+class ProgressRelay:
+    """
+    Messaggi prodotti nei thread di lavoro e mostrati dal thread principale
+    di Streamlit: gli elementi st.* non vanno scritti da più thread insieme.
+    Con immediate=True (uso dal thread principale) i messaggi escono subito.
+    """
+
+    def __init__(self, immediate=False):
+        self._queue = queue.Queue()
+        self._immediate = immediate
+        self._slots = {}  # chiave -> st.empty() aggiornato sul posto
+
+    def _put(self, kind, **payload):
+        self._queue.put((kind, payload))
+        if self._immediate:
+            self.drain()
+
+    def toast(self, msg, icon=None):
+        self._put("toast", msg=msg, icon=icon)
+
+    def info(self, msg):
+        self._put("info", msg=msg)
+
+    def warning(self, msg):
+        self._put("warning", msg=msg)
+
+    def error(self, msg):
+        self._put("error", msg=msg)
+
+    def status(self, key, level, msg):
+        """Messaggio che si aggiorna sul posto (uno per chiave, es. per documento)."""
+        self._put("status", key=key, level=level, msg=msg)
+
+    def detail(self, title, text):
+        """Testo lungo (es. errore) in un expander."""
+        self._put("detail", title=title, text=text)
+
+    def drain(self):
+        """Mostra i messaggi accodati (solo dal thread principale)."""
+        while True:
+            try:
+                kind, p = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "toast":
+                st.toast(p["msg"], icon=p["icon"])
+            elif kind == "status":
+                if p["key"] not in self._slots:
+                    self._slots[p["key"]] = st.empty()
+                getattr(self._slots[p["key"]], p["level"])(p["msg"])
+            elif kind == "detail":
+                with st.expander(p["title"]):
+                    st.code(p["text"])
+            else:
+                getattr(st, kind)(p["msg"])
+
+    def wait(self, futures, poll=0.2):
+        """Attende i future mostrando i messaggi man mano che arrivano."""
+        pending = set(futures)
+        while pending:
+            _, pending = wait_futures(pending, timeout=poll, return_when=FIRST_COMPLETED)
+            self.drain()
+        self.drain()
+
+
 # ==============================================================================
 # AI SETUP
 # ==============================================================================
@@ -109,48 +324,262 @@ def get_api_keys():
     return google_key, deepseek_key
 
 
+def _model_priority(name):
+    """Priorità: flash > lite > pro."""
+    n = name.lower()
+    if "flash" in n and "lite" not in n:
+        return 0
+    if "lite" in n:
+        return 1
+    if "pro" in n:
+        return 2
+    return 3
+
+
+def fetch_model_catalog():
+    """Interroga list_models, salva su disco e ritorna i nomi Gemini per priorità."""
+    genai = lazy_import("google.generativeai")
+    valid = [
+        m
+        for m in genai.list_models()
+        if "generateContent" in m.supported_generation_methods
+    ]
+    names = []
+    for m in valid:
+        name = m.name.replace("models/", "")
+        if "gemini" in name.lower() and "embedding" not in name.lower():
+            names.append(name)
+    names.sort(key=_model_priority)
+
+    try:
+        MODEL_CATALOG_FILE.write_text(json.dumps({"ts": time.time(), "models": names}))
+    except:
+        pass
+    return names
+
+
+class ModelCatalog:
+    """
+    Catalogo modelli persistito su disco con TTL: all'avvio si usa la copia
+    salvata (anche se scaduta) e list_models viene rieseguito in background.
+    Gli oggetti GenerativeModel si creano solo al primo utilizzo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._ts = 0.0
+        self._refreshing = False
+        self._models = {}
+        try:
+            saved = json.loads(MODEL_CATALOG_FILE.read_text())
+            self._names, self._ts = saved["models"], saved["ts"]
+        except:
+            pass
+
+    def names(self):
+        with self._lock:
+            names, ts = self._names, self._ts
+        if names is None:
+            # Primo avvio in assoluto: nessuna copia, serve il catalogo subito
+            names = fetch_model_catalog()
+            with self._lock:
+                self._names, self._ts = names, time.time()
+        elif time.time() - ts > MODEL_CATALOG_TTL:
+            self._refresh_in_background()
+        return list(names)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _refresh():
+            try:
+                names = fetch_model_catalog()
+                with self._lock:
+                    self._names, self._ts = names, time.time()
+            except:
+                pass  # Si continua con la copia scaduta
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_refresh, name="model-catalog", daemon=True).start()
+
+    def model(self, name):
+        with self._lock:
+            if name not in self._models:
+                genai = lazy_import("google.generativeai")
+                self._models[name] = genai.GenerativeModel(name)
+            return self._models[name]
+
+
 @st.cache_resource
-def init_gemini_models():
-    """Inizializza tutti i modelli Gemini disponibili."""
+def get_model_catalog():
+    """Catalogo per processo; None senza GOOGLE_API_KEY."""
     google_key, _ = get_api_keys()
     if not google_key:
-        return []
+        return None
+    lazy_import("google.generativeai").configure(api_key=google_key)
+    return ModelCatalog()
 
-    genai.configure(api_key=google_key)
 
+@st.cache_resource
+def get_deepseek_client():
+    """
+    Client DeepSeek per processo: connessioni HTTP keep-alive riusate tra
+    documenti e analisi, timeout espliciti. None senza chiave o SDK.
+    """
+    _, deepseek_key = get_api_keys()
+    OpenAI = lazy_import("openai", "OpenAI") if deepseek_key else None
+    httpx = lazy_import("httpx") if OpenAI else None
+    if not httpx:
+        return None
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=AI_WORKERS,
+            max_keepalive_connections=AI_WORKERS,
+            keepalive_expiry=5 * 60,
+        ),
+    )
+    return OpenAI(
+        api_key=deepseek_key,
+        base_url="https://api.deepseek.com",
+        http_client=http_client,
+        max_retries=1,
+    )
+
+
+def init_gemini_models(relay=None):
+    """Nomi dei modelli Gemini disponibili, in ordine di priorità."""
+    catalog = get_model_catalog()
+    if catalog is None:
+        return []
     try:
-        all_models = genai.list_models()
-        valid = [
-            m for m in all_models if "generateContent" in m.supported_generation_methods
-        ]
-
-        gemini_models = []
-        for m in valid:
-            name = m.name.replace("models/", "")
-            if "gemini" in name.lower() and "embedding" not in name.lower():
-                try:
-                    gemini_models.append((name, genai.GenerativeModel(name)))
-                except:
-                    continue
-
-        # Priorità: flash > lite > pro
-        def priority(n):
-            n = n.lower()
-            if "flash" in n and "lite" not in n:
-                return 0
-            if "lite" in n:
-                return 1
-            if "pro" in n:
-                return 2
-            return 3
-
-        gemini_models.sort(key=lambda x: priority(x[0]))
-        return gemini_models
+        return catalog.names()
     except Exception as e:
-        st.warning(f"Errore init modelli: {e}")
+        (relay or st).warning(f"Errore init modelli: {e}")
         return []
 
 
+# ==============================================================================
+# ROUTER MODELLI (LATENZA + SALUTE)
+# ==============================================================================
+ROUTER_WINDOW = 20  # Esiti recenti considerati per modello
+ROUTER_PRIOR_LATENCY = 8.0  # Secondi stimati per un modello mai provato
+ROUTER_MAX_FAILURES = 3  # Fallimenti consecutivi prima di aprire il circuito
+ROUTER_COOLDOWN_ERROR = 60  # Pausa (s) dopo fallimenti ripetuti
+ROUTER_COOLDOWN_QUOTA = 10 * 60  # Pausa (s) dopo 429 / quota esaurita
+
+
+class ModelRouter:
+    """
+    Statistiche per modello (latenza p50/p95, quota di JSON validi, errori
+    recenti) con circuit breaker: un modello in pausa non viene riprovato per
+    ogni documento. I candidati sono ordinati per tempo atteso fino a un
+    risultato valido (p50 / probabilità di successo).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get(self, name):
+        if name not in self._stats:
+            self._stats[name] = {
+                "lat": deque(maxlen=ROUTER_WINDOW),
+                "esiti": deque(maxlen=ROUTER_WINDOW),
+                "fail_streak": 0,
+                "open_until": 0.0,
+                "last_error": "",
+            }
+        return self._stats[name]
+
+    def _expected(self, name, rank):
+        s = self._get(name)
+        # Senza storico vale l'ordine del catalogo (flash > lite > pro)
+        p50 = median(s["lat"]) if s["lat"] else ROUTER_PRIOR_LATENCY * (1 + rank / 10)
+        ok_rate = (sum(s["esiti"]) + 1) / (len(s["esiti"]) + 2)
+        return p50 / ok_rate
+
+    def order(self, names):
+        """Modelli disponibili, dal più promettente (mai vuota se names non lo è)."""
+        now = time.time()
+        with self._lock:
+            ready = [n for n in names if self._get(n)["open_until"] <= now]
+            if not ready and names:
+                # Tutti in pausa: si tenta solo quello che si riapre per primo
+                ready = [min(names, key=lambda n: self._stats[n]["open_until"])]
+            rank = {n: i for i, n in enumerate(names)}
+            return sorted(ready, key=lambda n: (self._expected(n, rank[n]), rank[n]))
+
+    @staticmethod
+    def classify(error):
+        """'quota' per 429/ResourceExhausted, altrimenti 'error'."""
+        text = f"{type(error).__name__} {error}".lower()
+        if any(k in text for k in ("429", "quota", "resourceexhausted", "rate limit")):
+            return "quota"
+        return "error"
+
+    def record(self, name, latency, outcome, error=None):
+        """outcome: 'ok' | 'invalid' (JSON non valido) | 'quota' | 'error'."""
+        with self._lock:
+            s = self._get(name)
+            s["esiti"].append(outcome == "ok")
+            if outcome in ("ok", "invalid"):
+                s["lat"].append(latency)
+            if error is not None:
+                s["last_error"] = str(error)[:200]
+
+            if outcome == "ok":
+                s["fail_streak"] = 0
+                return
+            s["fail_streak"] += 1
+            if outcome == "quota":
+                cooldown = ROUTER_COOLDOWN_QUOTA
+            elif s["fail_streak"] >= ROUTER_MAX_FAILURES:
+                cooldown = ROUTER_COOLDOWN_ERROR
+            else:
+                return
+            s["open_until"] = time.time() + cooldown
+            # Dopo la pausa basta un altro fallimento per riaprire il circuito
+            s["fail_streak"] = ROUTER_MAX_FAILURES - 1
+
+    def snapshot(self):
+        """Righe per la UI: una per modello con p50/p95, % JSON validi, stato."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for name, s in self._stats.items():
+                lat = sorted(s["lat"])
+                rows.append(
+                    {
+                        "modello": name,
+                        "p50 (s)": round(median(lat), 1) if lat else None,
+                        "p95 (s)": (
+                            round(lat[int(0.95 * (len(lat) - 1))], 1) if lat else None
+                        ),
+                        "JSON validi": f"{sum(s['esiti'])}/{len(s['esiti'])}",
+                        "stato": (
+                            f"in pausa {int(s['open_until'] - now)}s"
+                            if s["open_until"] > now
+                            else "attivo"
+                        ),
+                        "ultimo errore": s["last_error"],
+                    }
+                )
+        return rows
+
+
+@st.cache_resource
+def get_model_router():
+    """Statistiche condivise da tutte le sessioni del processo."""
+    return ModelRouter()
+
+
 def clean_json_response(text):
     """Pulisce e parsa JSON dalla risposta AI."""
     try:
@@ -165,80 +594,134 @@ def clean_json_response(text):
         return None
 
 
-def extract_text_from_pdf(file_path):
-    """Estrae testo da PDF usando PyMuPDF o pypdf."""
-    if not file_path or not os.path.exists(file_path):
-        return None
+class PdfDocument:
+    """
+    PDF tenuto in memoria dal download all'analisi: i byte, un solo
+    fitz.Document aperto dallo stream al primo uso e testo/parole estratti
+    una volta sola per chiave cache, parser locali, Gemini e DeepSeek.
+    """
 
-    # Prova PyMuPDF
-    if fitz:
-        try:
-            doc = fitz.open(file_path)
-            text = "\n".join([p.get_text() for p in doc])
-            if text.strip():
-                return text.strip()
-        except:
-            pass
+    def __init__(self, data, name="documento.pdf"):
+        self.data = data
+        self.name = name
+        self._lock = threading.Lock()
+        self._fitz_doc = None
+        self._text = None
+        self._words = None
+
+    @property
+    def is_pdf(self):
+        return self.data[:4] == b"%PDF"
+
+    def fitz_doc(self):
+        """Documento PyMuPDF aperto dallo stream (None senza PyMuPDF)."""
+        with self._lock:
+            if self._fitz_doc is None:
+                fitz = lazy_import("fitz")
+                if not fitz:
+                    return None
+                try:
+                    self._fitz_doc = fitz.open(stream=self.data, filetype="pdf")
+                except Exception:
+                    return None
+            return self._fitz_doc
+
+    def text(self):
+        """Testo del PDF con PyMuPDF o pypdf, estratto una volta sola."""
+        if self._text is not None:
+            return self._text or None
+
+        text = ""
+        # Prova PyMuPDF
+        doc = self.fitz_doc()
+        if doc:
+            try:
+                text = "\n".join([p.get_text() for p in doc]).strip()
+            except:
+                text = ""
 
-    # Prova pypdf
-    if PdfReader:
-        try:
-            reader = PdfReader(file_path)
-            text = "\n".join([p.extract_text() or "" for p in reader.pages])
-            if text.strip():
-                return text.strip()
-        except:
-            pass
+        # Prova pypdf
+        PdfReader = lazy_import("pypdf", "PdfReader") if not text else None
+        if PdfReader:
+            try:
+                reader = PdfReader(io.BytesIO(self.data))
+                text = "\n".join([p.extract_text() or "" for p in reader.pages]).strip()
+            except:
+                pass
 
-    return None
+        self._text = text
+        return text or None
 
+    def words(self):
+        """[(pagina, parole PyMuPDF)] con coordinate, estratte una volta sola."""
+        if self._words is None:
+            doc = self.fitz_doc()
+            try:
+                self._words = (
+                    [(pno, page.get_text("words")) for pno, page in enumerate(doc)]
+                    if doc
+                    else []
+                )
+            except Exception:
+                self._words = []
+        return self._words
 
-def analyze_with_fallback(file_path, prompt, tipo="documento"):
-    """Analizza PDF con Gemini, fallback su DeepSeek."""
-    if not file_path or not os.path.exists(file_path):
-        return None
 
-    with open(file_path, "rb") as f:
-        pdf_bytes = f.read()
+def analyze_with_fallback(doc, prompt, tipo="documento", relay=None):
+    """
+    Analizza PDF con Gemini, fallback su DeepSeek.
+    Con un relay può girare in un thread di lavoro: i messaggi vengono
+    mostrati dal thread principale.
+    """
+    relay = relay or ProgressRelay(immediate=True)
+    if not doc:
+        return None
 
-    if pdf_bytes[:4] != b"%PDF":
-        st.error(f"❌ {tipo} non è un PDF valido")
+    pdf_bytes = doc.data
+    if not doc.is_pdf:
+        relay.error(f"❌ {tipo} non è un PDF valido")
         return None
 
-    models = init_gemini_models()
-    _, deepseek_key = get_api_keys()
+    models = init_gemini_models(relay)
 
-    progress = st.empty()
     last_error = None
 
-    # Prova tutti i modelli Gemini
-    for idx, (name, model) in enumerate(models, 1):
-        try:
-            progress.info(f"🔄 {tipo}: modello {idx}/{len(models)} ({name})...")
-            resp = model.generate_content(
-                [prompt, {"mime_type": "application/pdf", "data": pdf_bytes}]
-            )
-            result = clean_json_response(getattr(resp, "text", ""))
-            if result and isinstance(result, dict):
-                progress.success(f"✅ {tipo} analizzato!")
-                time.sleep(0.3)
-                progress.empty()
-                return result
-        except Exception as e:
-            last_error = e
-            continue
+    # Modelli Gemini nell'ordine del router (quelli in pausa vengono saltati)
+    candidates = get_model_router().order(models)
+    if AI_HEDGE_DELAY is not None and len(candidates) > 1:
+        result, last_error = _gemini_hedged(candidates, prompt, pdf_bytes, tipo, relay)
+        if result:
+            relay.status(tipo, "success", f"✅ {tipo} analizzato!")
+            return result
+    else:
+        for idx, name in enumerate(candidates, 1):
+            try:
+                relay.status(
+                    tipo,
+                    "info",
+                    f"🔄 {tipo}: modello {idx}/{len(candidates)} ({name})...",
+                )
+                result = _call_gemini(name, prompt, pdf_bytes)
+                if result:
+                    relay.status(tipo, "success", f"✅ {tipo} analizzato!")
+                    return result
+            except Exception as e:
+                last_error = e
+                continue
 
     # Fallback DeepSeek
-    if deepseek_key and OpenAI:
+    client = get_deepseek_client()
+    if client:
         try:
-            progress.warning(f"⚠️ Gemini esaurito. Fallback DeepSeek per {tipo}...")
-            text = extract_text_from_pdf(file_path)
+            relay.status(
+                tipo, "warning", f"⚠️ Gemini esaurito. Fallback DeepSeek per {tipo}..."
+            )
+            text = compact_pdf_text(doc, tipo)
             if not text or len(text) < 50:
-                progress.error("❌ PDF non leggibile per DeepSeek")
+                relay.status(tipo, "error", "❌ PDF non leggibile per DeepSeek")
                 return None
 
-            client = OpenAI(api_key=deepseek_key, base_url="https://api.deepseek.com")
-            full_prompt = prompt + "\n\n--- TESTO PDF ---\n" + text[:25000]
+            full_prompt = prompt + "\n\n--- TESTO PDF ---\n" + text
 
             resp = client.chat.completions.create(
                 model="deepseek-chat",
@@ -250,24 +733,784 @@ def analyze_with_fallback(file_path, prompt, tipo="documento"):
             )
             result = clean_json_response(resp.choices[0].message.content)
             if result:
-                progress.success(f"✅ {tipo} analizzato (DeepSeek)!")
-                time.sleep(0.3)
-                progress.empty()
+                relay.status(tipo, "success", f"✅ {tipo} analizzato (DeepSeek)!")
                 return result
         except Exception as e:
             last_error = e
 
-    progress.error(f"❌ Analisi {tipo} fallita")
+    relay.status(tipo, "error", f"❌ Analisi {tipo} fallita")
     if last_error:
-        with st.expander("🔎 Errore"):
-            st.code(str(last_error)[:500])
+        relay.detail("🔎 Errore", str(last_error)[:500])
+    return None
+
+
+def _call_gemini(name, prompt, pdf_bytes):
+    """Una chiamata Gemini con esito registrato nel router. None se JSON non valido."""
+    router = get_model_router()
+    t0 = time.perf_counter()
+    try:
+        resp = get_model_catalog().model(name).generate_content(
+            [prompt, {"mime_type": "application/pdf", "data": pdf_bytes}],
+            request_options={"timeout": AI_READ_TIMEOUT},
+        )
+    except Exception as e:
+        router.record(name, time.perf_counter() - t0, router.classify(e), e)
+        raise
+    result = clean_json_response(getattr(resp, "text", ""))
+    if result and isinstance(result, dict):
+        router.record(name, time.perf_counter() - t0, "ok")
+        return result
+    router.record(name, time.perf_counter() - t0, "invalid")
     return None
 
 
+def _gemini_hedged(candidates, prompt, pdf_bytes, tipo, relay):
+    """
+    Richieste "hedged": se il modello in corso non risponde entro
+    AI_HEDGE_DELAY secondi parte anche il successivo (fino a AI_HEDGE_FANOUT
+    in parallelo; con ritardo 0 partono subito i primi N). Vince il primo
+    JSON valido, le risposte successive vengono ignorate.
+    Ritorna (risultato, ultimo_errore).
+    """
+    executor = get_hedge_executor()
+    pending = list(candidates)
+    running = {}
+    last_error = None
+
+    def launch():
+        name = pending.pop(0)
+        running[executor.submit(_call_gemini, name, prompt, pdf_bytes)] = name
+        relay.status(
+            tipo, "info", f"🔄 {tipo}: in corso {', '.join(running.values())}..."
+        )
+
+    launch()
+    while pending and AI_HEDGE_DELAY == 0 and len(running) < AI_HEDGE_FANOUT:
+        launch()
+
+    while running:
+        can_hedge = pending and len(running) < AI_HEDGE_FANOUT
+        done, _ = wait_futures(
+            running,
+            timeout=AI_HEDGE_DELAY if can_hedge else None,
+            return_when=FIRST_COMPLETED,
+        )
+        if not done:
+            launch()
+            continue
+
+        for fut in done:
+            running.pop(fut)
+            try:
+                result = fut.result()
+            except Exception as e:
+                last_error = e
+                result = None
+            if result:
+                for other in running:
+                    other.cancel()  # Solo se non ancora partita
+                return result, last_error
+
+        # Nessun vincitore: il posto liberato va subito al prossimo candidato
+        if pending and len(running) < AI_HEDGE_FANOUT:
+            launch()
+
+    return None, last_error
+
+
+@st.cache_resource
+def get_hedge_executor():
+    """Thread per le chiamate hedged (più modelli per documento)."""
+    return ThreadPoolExecutor(
+        max_workers=AI_WORKERS * AI_HEDGE_FANOUT, thread_name_prefix="hedge"
+    )
+
+
+@st.cache_resource
+def get_ai_executor():
+    """Pool limitato per le analisi AI, condiviso da tutte le sessioni."""
+    return ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="ai")
+
+
+def submit_ai(fn, *args):
+    """Accoda fn(*args) sul pool AI con il contesto Streamlit della sessione."""
+    script_ctx = get_script_run_ctx()
+
+    def _task():
+        add_script_run_ctx(threading.current_thread(), script_ctx)
+        return fn(*args)
+
+    return get_ai_executor().submit(_task)
+
+
+# ==============================================================================
+# CACHE RISULTATI AI (CONTENT-ADDRESSED)
+# ==============================================================================
+def ai_cache_key(kind, doc, prompt):
+    """
+    (nome voce, cifratore) per PDF + tipo + versione schema + prompt.
+    Il nome è lo SHA-256 di tutto, la chiave Fernet deriva dai soli byte del
+    PDF. None senza documento o senza cryptography.
+    """
+    Fernet = lazy_import("cryptography.fernet", "Fernet")
+    if not doc or not Fernet:
+        return None
+    h = hashlib.sha256()
+    h.update(doc.data)
+    h.update(f"|{kind}|{AI_SCHEMA_VERSION}|".encode())
+    h.update(hashlib.sha256(prompt.encode()).digest())
+    secret = hashlib.sha256(b"ai-cache|" + doc.data).digest()
+    return h.hexdigest(), Fernet(base64.urlsafe_b64encode(secret))
+
+
+def ai_cache_get(key):
+    """Risultato salvato per la chiave, se presente e non scaduto."""
+    if not key:
+        return None
+    name, fernet = key
+    path = AI_CACHE_DIR / f"{name}.bin"
+    try:
+        if time.time() - path.stat().st_mtime > AI_CACHE_MAX_AGE:
+            path.unlink()
+            return None
+        data = json.loads(fernet.decrypt(path.read_bytes()))
+        os.utime(path)  # Ultimo uso: l'eviction per dimensione parte dai più vecchi
+        return data
+    except:
+        return None
+
+
+def ai_cache_put(key, result):
+    if not key or not result:
+        return
+    name, fernet = key
+    try:
+        AI_CACHE_DIR.mkdir(exist_ok=True)
+        path = AI_CACHE_DIR / f"{name}.bin"
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(fernet.encrypt(json.dumps(result).encode()))
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+        _prune_ai_cache()
+    except:
+        pass
+
+
+def _prune_ai_cache():
+    """Elimina le voci scadute, poi le meno usate finché si rientra nel limite."""
+    entries = []
+    for p in AI_CACHE_DIR.glob("*.bin"):
+        try:
+            stat = p.stat()
+            entries.append((stat.st_mtime, stat.st_size, p))
+        except OSError:
+            continue
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, p in entries:
+        if now - mtime <= AI_CACHE_MAX_AGE and total <= AI_CACHE_MAX_BYTES:
+            continue
+        try:
+            p.unlink()
+            total -= size
+        except OSError:
+            pass
+
+
+# ==============================================================================
+# ARCHIVIO DOCUMENTI LOCALE (CIFRATO)
+# ==============================================================================
+class DocumentArchive:
+    """
+    PDF già scaricati di un utente, cifrati con una chiave derivata dalla
+    password (PBKDF2 + Fernet). Un documento si riscarica solo se manca, se
+    il suo link nel catalogo del portale è cambiato, se il mese è ancora
+    aperto o, per il cartellino, se l'ultima verifica è più vecchia di
+    ARCHIVE_CART_RECHECK; oltre ARCHIVE_RETENTION_DAYS viene eliminato.
+    """
+
+    def __init__(self, user, pwd, fernet_cls, kdf_cls, hashes):
+        self.dir = ARCHIVE_DIR / hashlib.sha256(user.encode()).hexdigest()[:16]
+        self.dir.mkdir(parents=True, exist_ok=True)
+        salt_file = self.dir / "salt"
+        if not salt_file.exists():
+            salt_file.write_bytes(os.urandom(16))
+        kdf = kdf_cls(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt_file.read_bytes(),
+            iterations=ARCHIVE_KDF_ITERATIONS,
+        )
+        self._fernet = fernet_cls(base64.urlsafe_b64encode(kdf.derive(pwd.encode())))
+        self._index_file = self.dir / "index.json"
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(link):
+        """Impronta di un link del catalogo (testo + URL); None senza catalogo."""
+        if not link:
+            return None
+        return hashlib.sha256(f"{link['text']}|{link['href']}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _open_month(anno, mese):
+        oggi = time.localtime()
+        return (anno, mese) >= (oggi.tm_year, oggi.tm_mon)
+
+    def _index(self):
+        try:
+            return json.loads(self._index_file.read_text())
+        except Exception:
+            return {}
+
+    def _name(self, kind, anno, mese):
+        return f"{kind}_{anno}_{mese:02d}"
+
+    def fresh(self, kind, anno, mese, link=None):
+        """True se l'archivio ha il documento e non serve riscaricarlo."""
+        entry = self._index().get(self._name(kind, anno, mese))
+        if not entry or self._open_month(anno, mese):
+            return False
+        if kind == "cart":
+            verificato = entry.get("verificato", entry["salvato"])
+            return time.time() - verificato < ARCHIVE_CART_RECHECK
+        firma = self.signature(link)
+        return not (firma and entry.get("firma") and firma != entry["firma"])
+
+    def restore(self, kind, anno, mese, link=None):
+        """Byte decifrati del documento se aggiornato; None se va scaricato."""
+        if not self.fresh(kind, anno, mese, link):
+            return None
+        return self._decrypt(self._name(kind, anno, mese))
+
+    def _decrypt(self, name):
+        try:
+            return self._fernet.decrypt((self.dir / f"{name}.bin").read_bytes())
+        except Exception:
+            # File mancante o password cambiata (chiave diversa): si riscarica
+            return None
+
+    def store(self, kind, anno, mese, data, link=None):
+        """
+        Cifra e archivia un PDF appena scaricato. True se sostituisce una
+        versione archiviata con contenuto diverso (documento corretto).
+        """
+        name = self._name(kind, anno, mese)
+        sha = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            index = self._index()
+            old = index.get(name)
+            now = time.time()
+            if old and old["sha256"] == sha and self._decrypt(name) is not None:
+                # Stesso contenuto leggibile con la chiave attuale: solo la verifica
+                old["verificato"] = now
+                old["firma"] = self.signature(link) or old.get("firma")
+            else:
+                # Nuovo, cambiato o cifrato con una password precedente
+                (self.dir / f"{name}.bin").write_bytes(self._fernet.encrypt(data))
+                index[name] = {
+                    "salvato": now,
+                    "verificato": now,
+                    "byte": len(data),
+                    "sha256": sha,
+                    "firma": self.signature(link),
+                }
+            self._prune(index)
+            self._index_file.write_text(json.dumps(index))
+        return bool(old) and old["sha256"] != sha
+
+    def _prune(self, index):
+        limit = time.time() - ARCHIVE_RETENTION_DAYS * 24 * 3600
+        for name in [n for n, e in index.items() if e["salvato"] < limit]:
+            del index[name]
+            try:
+                (self.dir / f"{name}.bin").unlink()
+            except OSError:
+                pass
+
+    def summary(self):
+        index = self._index()
+        return {"documenti": len(index), "byte": sum(e["byte"] for e in index.values())}
+
+
+@st.cache_resource
+def get_archive_registry():
+    """sha256(utente:password) -> DocumentArchive (chiave derivata una volta)."""
+    return {}
+
+
+def get_document_archive(user, pwd):
+    """Archivio dell'utente; None se spento o se cryptography non è installato."""
+    if ARCHIVE_RETENTION_DAYS <= 0 or not user or not pwd:
+        return None
+    fernet_cls = lazy_import("cryptography.fernet", "Fernet")
+    kdf_cls = lazy_import("cryptography.hazmat.primitives.kdf.pbkdf2", "PBKDF2HMAC")
+    hashes = lazy_import("cryptography.hazmat.primitives.hashes")
+    if not (fernet_cls and kdf_cls and hashes):
+        return None
+
+    registry = get_archive_registry()
+    key = hashlib.sha256(f"{user}:{pwd}".encode()).hexdigest()
+    if key not in registry:
+        registry[key] = DocumentArchive(user, pwd, fernet_cls, kdf_cls, hashes)
+    return registry[key]
+
+
+# ==============================================================================
+# PARSER LOCALI (PyMuPDF, SENZA RETE)
+# ==============================================================================
+# Numero in formato italiano: 1.234,56 / 26 / 12,50- (segno meno finale)
+NUM_IT_RE = re.compile(r"^-?(?:\d{1,3}(?:\.\d{3})+|\d+)(?:,\d+)?-?$")
+
+
+def parse_num_it(txt):
+    """'1.234,56' -> 1234.56, '12,50-' -> -12.5; None se non è un numero."""
+    txt = (txt or "").strip()
+    if not NUM_IT_RE.match(txt):
+        return None
+    neg = txt.startswith("-") or txt.endswith("-")
+    val = float(txt.strip("-").replace(".", "").replace(",", "."))
+    return -val if neg else val
+
+
+def pdf_layout_lines(doc, y_tol=2.5):
+    """
+    Parole del PDF raggruppate in righe visive, con coordinate.
+    Ritorna [{"page", "y", "words": [(x0, x1, testo)], "text"}] in ordine di lettura.
+    """
+    if not doc:
+        return []
+
+    lines = []
+    for pno, page_words in doc.words():
+        words = sorted(page_words, key=lambda w: ((w[1] + w[3]) / 2, w[0]))
+        current = None
+        for x0, y0, x1, y1, txt, *_ in words:
+            yc = (y0 + y1) / 2
+            if current is None or abs(yc - current["y"]) > y_tol:
+                current = {"page": pno, "y": yc, "words": []}
+                lines.append(current)
+            current["words"].append((x0, x1, txt))
+
+    for line in lines:
+        line["words"].sort()
+        line["text"] = " ".join(w[2] for w in line["words"]).upper()
+    return lines
+
+
+def _find_label(line, label_re):
+    """Span (x0, x1) della sequenza di parole che corrisponde a label_re."""
+    words = line["words"]
+    for i in range(len(words)):
+        for k in range(1, 5):
+            if i + k > len(words):
+                break
+            chunk = " ".join(w[2] for w in words[i : i + k]).upper()
+            if label_re.fullmatch(chunk):
+                return words[i][0], words[i + k - 1][1]
+    return None
+
+
+def _line_numbers(line, min_x=None):
+    """[(x_centro, valore)] dei numeri della riga, opzionalmente a destra di min_x."""
+    out = []
+    for x0, x1, txt in line["words"]:
+        if min_x is not None and x0 < min_x:
+            continue
+        val = parse_num_it(txt)
+        if val is not None:
+            out.append(((x0 + x1) / 2, val))
+    return out
+
+
+def _label_value(lines, label, max_dy=22):
+    """
+    Valore associato a un'etichetta: prima nella casella sotto (layout a
+    riquadri del cedolino), poi sulla stessa riga a destra.
+    """
+    label_re = re.compile(label, re.I)
+    for i, line in enumerate(lines):
+        span = _find_label(line, label_re)
+        if not span:
+            continue
+        x0, x1 = span
+        for below in lines[i + 1 :]:
+            if below["page"] != line["page"] or below["y"] - line["y"] > max_dy:
+                break
+            near = [v for xc, v in _line_numbers(below) if x0 - 15 <= xc <= x1 + 15]
+            if len(near) == 1:
+                return near[0]
+        right = _line_numbers(line, min_x=x1)
+        if right:
+            return right[0][1]
+    return None
+
+
+def _column_value(line, col_x, tol=45):
+    """Numero della riga più vicino alla colonna col_x (entro tol punti)."""
+    cands = [
+        (abs(xc - col_x), v) for xc, v in _line_numbers(line) if abs(xc - col_x) <= tol
+    ]
+    return min(cands)[1] if cands else None
+
+
+def parse_busta_locale(doc):
+    """
+    Legge il cedolino Gottardo dalle coordinate delle parole, senza AI.
+    Ritorna (risultato, campi_mancanti): i campi mancanti sono quelli non
+    trovati con certezza, da chiedere al modello.
+    """
+    result = empty_busta()
+    missing = {
+        (sec, key)
+        for sec, fields in result.items()
+        if isinstance(fields, dict)
+        for key in fields
+    }
+    lines = pdf_layout_lines(doc)
+    if not lines:
+        return None, missing
+
+    def found(sec, key, val):
+        if val is None:
+            return
+        result[sec][key] = round(val, 5)
+        missing.discard((sec, key))
+
+    full_text = "\n".join(l["text"] for l in lines)
+    result["e_tredicesima"] = bool(re.search(r"TREDICESIMA|13\s*MA\b", full_text))
+
+    # --- DATI GENERALI ---
+    netto = None
+    for i, line in enumerate(lines):
+        if "PROGRESSIVI" not in line["text"]:
+            continue
+        nums = _line_numbers(line) or (
+            _line_numbers(lines[i + 1]) if i + 1 < len(lines) else []
+        )
+        if nums:
+            netto = nums[-1][1]
+        break
+    found("dati_generali", "netto", netto if netto and netto > 0 else None)
+
+    gg = _label_value(lines, r"GG\.?\s*INPS")
+    if gg is not None and 0 <= gg <= 31 and gg == int(gg):
+        found("dati_generali", "giorni_pagati", int(gg))
+
+    ore = _label_value(lines, r"ORE\s*INAIL")
+    if ore is None and gg:
+        ore = gg * 8
+    found("dati_generali", "ore_ordinarie", ore)
+
+    found("competenze", "lordo_totale", _label_value(lines, r"TOTALE\s+COMPETENZE"))
+    found("trattenute", "irpef_netta", _label_value(lines, r"IRPEF\s+NETTA"))
+
+    # --- CORPO VOCI (codice a 4 cifre + descrizione + importi) ---
+    col_comp = col_tratt = None
+    for line in lines:
+        comp = _find_label(line, re.compile(r"COMPETENZE"))
+        tratt = _find_label(line, re.compile(r"TRATTENUTE"))
+        if comp and tratt:
+            col_comp, col_tratt = sum(comp) / 2, sum(tratt) / 2
+            break
+
+    voci = [l for l in lines if l["words"] and re.fullmatch(r"\d{4}", l["words"][0][2])]
+    if col_comp is not None and len(voci) >= 3:
+
+        def voce_desc(line):
+            return " ".join(
+                w[2] for w in line["words"][1:] if parse_num_it(w[2]) is None
+            )
+
+        def voci_di(pattern, code=None):
+            return [
+                l
+                for l in voci
+                if l["words"][0][2] == code or re.search(pattern, voce_desc(l))
+            ]
+
+        def somma_colonna(rows, col_x):
+            vals = [_column_value(l, col_x) for l in rows]
+            vals = [v for v in vals if v is not None]
+            return sum(vals), bool(vals)
+
+        def competenze_di(pattern, code=None):
+            return somma_colonna(voci_di(pattern, code), col_comp)
+
+        def trattenute_di(pattern):
+            return somma_colonna(voci_di(pattern), col_tratt)
+
+        def ore_di(pattern, code=None):
+            # Prima quantità della riga (colonna ORE/GG), a sinistra degli importi
+            limit = min(col_comp, col_tratt) - 45
+            tot = 0.0
+            for l in voci_di(pattern, code):
+                qty = _line_numbers(l, min_x=l["words"][0][1])  # Dopo il codice
+                nums = [v for xc, v in qty if xc < limit]
+                if nums:
+                    tot += nums[0]
+            return tot
+
+        base, hit = competenze_di(r"RETRIBUZIONE ORDINARIA|PAGA BASE", code="1000")
+        if hit:
+            found("competenze", "base", base)
+        found(
+            "competenze",
+            "straordinari",
+            competenze_di(r"STRAORD|SUPPLEMENT|NOTTURN")[0],
+        )
+        found(
+            "competenze",
+            "festivita",
+            competenze_di(r"MAGG\.?\s*FEST|FESTIVITA'? GODUT")[0],
+        )
+        found("competenze", "anzianita", competenze_di(r"SCATT|\bEDR\b|ANZ\.")[0])
+
+        inps, hit = trattenute_di(r"I\.?N\.?P\.?S|\bIVS\b")
+        if hit:
+            found("trattenute", "inps", inps)
+        found(
+            "trattenute", "addizionali", trattenute_di(r"ADD\.?\s*(?:REG|COM)|ADDIZ")[0]
+        )
+
+        found("assenze_mese", "ore_ferie", ore_di(r"FERIE GODUTE", code="4521"))
+        found(
+            "assenze_mese",
+            "ore_permessi",
+            ore_di(r"(?:PERMESSI|ROL) GODUTI", code="4529"),
+        )
+        found("assenze_mese", "ore_malattia", ore_di(r"MALATTIA"))
+
+    # --- TABELLA FERIE/PAR: RES.PREC / SPETTANTI / FRUITE / SALDO ---
+    for line in lines:
+        first = line["words"][0][2].upper() if line["words"] else ""
+        nums = [v for _, v in _line_numbers(line)]
+        if len(nums) != 4:
+            continue
+        if first == "FERIE":
+            for key, val in zip(("residue_ap", "maturate", "godute", "saldo"), nums):
+                found("ferie", key, val)
+        elif first in ("PAR", "PERMESSI", "ROL"):
+            for key, val in zip(("residue_ap", "spettanti", "fruite", "saldo"), nums):
+                found("par", key, val)
+
+    return result, missing
+
+
+# Righe giornaliere del cartellino: "01 ME V70 08:30 13:00 14:00 17:30 7,00"
+CART_WEEKDAYS = {"LU", "MA", "ME", "GI", "VE", "SA", "DO"}
+CART_WEEKDAYS |= {"LUN", "MAR", "MER", "GIO", "VEN", "SAB", "DOM"}
+CART_TIME_RE = re.compile(r"^(\d{1,2})[:.](\d{2})[EU]?$")
+CART_CODE_RE = re.compile(r"^[A-Z][A-Z0-9]{1,3}$")
+CART_CATEGORIES = {
+    "festivita": {"F70", "FST", "FES"},
+    "ferie": {"FER", "FE", "FEP"},
+    "permessi": {"PAR", "PER", "ROL"},
+    "malattia": {"MAL"},
+    "riposi": {"RCO", "RDD", "RPS", "RCS", "RIC"},
+}
+
+
+def parse_cartellino_locale(doc):
+    """
+    Legge il cartellino riga per riga (giorno, codici, timbrature, ore) e i
+    totali del footer (0265 GG PRESENZA, 0253 ORE LAVORATE), senza AI.
+    None se il layout non è riconosciuto.
+    """
+    lines = pdf_layout_lines(doc)
+    if not lines:
+        return None
+
+    # Mese/anno dall'intestazione (es. "dal 01/10/2025"), per datare le righe
+    period = re.search(
+        r"\b\d{2}/(\d{2})/(20\d{2})\b", " ".join(l["text"] for l in lines)
+    )
+
+    days = {}
+    for line in lines:
+        words = [w[2].upper() for w in line["words"]]
+        if not words or not re.fullmatch(r"\d{1,2}", words[0]):
+            continue
+        day = int(words[0])
+        rest = words[1:]
+        if rest and rest[0] in CART_WEEKDAYS:
+            rest = rest[1:]
+        elif not any(CART_TIME_RE.match(w) or CART_CODE_RE.match(w) for w in rest):
+            continue
+        if not 1 <= day <= 31:
+            continue
+
+        entry = days.setdefault(
+            day,
+            {"giorno": day, "codici": [], "timbrature": [], "ore": 0.0, "testo": ""},
+        )
+        for w in rest:
+            if CART_TIME_RE.match(w):
+                entry["timbrature"].append(w.rstrip("EU").replace(".", ":"))
+            elif CART_CODE_RE.match(w) and w not in entry["codici"]:
+                entry["codici"].append(w)
+        nums = [parse_num_it(w) for w in rest]
+        nums = [n for n in nums if n is not None and 0 < n <= 24]
+        if nums:
+            entry["ore"] += nums[-1]
+        entry["testo"] = (entry["testo"] + " " + " ".join(rest)).strip()
+
+    # Meno di 10 giorni riconosciuti: layout diverso, meglio il modello
+    if len(days) < 10:
+        return None
+
+    def footer(code, label):
+        for line in lines:
+            span = _find_label(line, re.compile(rf"{code}|{label}"))
+            if span:
+                right = _line_numbers(line, min_x=span[1])
+                right = [v for _, v in right if str(int(v)).zfill(4) != code]
+                if right:
+                    return right[0]
+        return None
+
+    giorni_footer = footer("0265", r"GG\.?\s*PRESENZA")
+    ore_footer = footer("0253", r"ORE\s+LAVORATE")
+
+    counts = {key: 0 for key in CART_CATEGORIES}
+    giorni_righe = omesse = 0
+    dettaglio = []
+    for day in sorted(days):
+        entry = days[day]
+        codes = set(entry["codici"])
+        worked = (
+            bool(entry["timbrature"])
+            or any(re.fullmatch(r"V\d{2}", c) for c in codes)
+            or bool(codes & {"ORD", "STR"})
+        )
+        giorni_righe += worked
+        for key, group in CART_CATEGORIES.items():
+            counts[key] += bool(codes & group)
+        omesse += bool(re.search(r"OMESSA|ANOMALIA|MANCATA", entry["testo"]))
+
+        entry["ore"] = round(entry["ore"], 2)
+        entry["lavorato"] = worked
+        if period:
+            entry["data"] = f"{period.group(2)}-{period.group(1)}-{day:02d}"
+        del entry["testo"]
+        dettaglio.append(entry)
+
+    note = ""
+    if giorni_footer is not None and giorni_footer != giorni_righe:
+        note = f"Footer {giorni_footer:g} GG presenza vs {giorni_righe} righe lavorate"
+
+    return {
+        "giorni_lavorati": giorni_footer if giorni_footer else giorni_righe,
+        "giorni_footer": giorni_footer or 0,
+        "giorni_righe": giorni_righe,
+        "ore_lavorate": (
+            ore_footer
+            if ore_footer is not None
+            else round(sum(d["ore"] for d in dettaglio), 2)
+        ),
+        **counts,
+        "omesse_timbrature": omesse,
+        "note": note,
+        "giorni_dettaglio": dettaglio,
+    }
+
+
+# ==============================================================================
+# TESTO COMPATTO PER DEEPSEEK
+# ==============================================================================
+# Righe che il prompt di ciascun documento non può perdere (totali, footer)
+COMPACT_KEY_LINES = {
+    "Busta Paga": re.compile(
+        r"PROGRESSIVI|NETTO|TOTALE\s+(?:COMPETENZE|TRATTENUTE)|GG\.?\s*INPS|ORE\s+INAIL"
+        r"|RETRIBUZIONE\s+ORDINARIA|PAGA\s+BASE|STRAORD|SUPPLEMENT|NOTTURN|FESTIV"
+        r"|SCATTI|E\.?D\.?R|ANZ|INPS|IRPEF|ADDIZ|FERIE|PERMESS|\bPAR\b|\bROL\b|TREDICESIMA"
+    ),
+    "Cartellino": re.compile(
+        r"\b0265\b|\b0253\b|GG\.?\s*PRESENZA|ORE\s+LAVORATE|TOTAL"
+    ),
+}
+COMPACT_BOILERPLATE_RE = re.compile(r"^(?:PAG(?:INA|\.)?\s*\d+(?:\s*(?:DI|/)\s*\d+)?)$")
+
+
+def _compact_row(line):
+    """Riga visiva in testo: colonne lontane separate da tab, il resto da spazi."""
+    out = ""
+    prev = None
+    for x0, x1, txt in line["words"]:
+        if prev is not None:
+            char_w = (prev[1] - prev[0]) / max(len(prev[2]), 1)
+            out += "\t" if x0 - prev[1] > 2.5 * char_w else " "
+        out += txt
+        prev = (x0, x1, txt)
+    return out
+
+
+def compact_pdf_text(doc, tipo="documento", budget=None):
+    """
+    Testo del PDF per i modelli solo-testo: spazi compressi, colonne delle
+    tabelle separate da tab, intestazioni ripetute su più pagine e
+    numeri di pagina tolti. Se supera il budget di token restano prima le
+    righe chiave del documento (con la riga successiva), poi le altre in
+    ordine di lettura.
+    """
+    budget = int((budget or DEEPSEEK_TOKEN_BUDGET) * CHARS_PER_TOKEN)
+
+    lines = pdf_layout_lines(doc)
+    if lines:
+        rows = [(line["page"], _compact_row(line)) for line in lines]
+    else:
+        # Senza PyMuPDF: testo semplice, le spaziature larghe diventano colonne
+        rows = [
+            (0, re.sub(r" +", " ", re.sub(r"[ \t]{3,}|\t", "\t", r)).strip())
+            for r in (doc.text() or "").splitlines()
+        ] if doc else []
+
+    # Intestazioni/piè di pagina: righe identiche su più pagine, tenute una volta
+    pages = {}
+    for pno, text in rows:
+        pages.setdefault(text.upper(), set()).add(pno)
+    seen = set()
+    kept = []
+    for pno, text in rows:
+        key = text.upper()
+        if not re.search(r"[A-Z0-9]", key) or COMPACT_BOILERPLATE_RE.match(key):
+            continue
+        if len(pages[key]) > 1:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(text)
+
+    total = sum(len(t) + 1 for t in kept)
+    if total <= budget:
+        return "\n".join(kept)
+
+    # Oltre il budget: righe chiave (e la successiva, dove spesso sta il valore)
+    key_re = COMPACT_KEY_LINES.get(tipo)
+    priority = set()
+    if key_re:
+        for i, text in enumerate(kept):
+            if key_re.search(text.upper()):
+                priority.update((i, i + 1))
+    order = sorted(range(len(kept)), key=lambda i: (i not in priority, i))
+
+    chosen = set()
+    used = 0
+    for i in order:
+        if i < len(kept) and used + len(kept[i]) + 1 <= budget:
+            chosen.add(i)
+            used += len(kept[i]) + 1
+    omitted = len(kept) - len(chosen)
+    text = "\n".join(kept[i] for i in sorted(chosen))
+    return text + f"\n[... {omitted} righe omesse per limite di lunghezza]"
+
+
 # ==============================================================================
 # PARSERS AI DETTAGLIATI
 # ==============================================================================
-def parse_busta_dettagliata(path):
+def parse_busta_dettagliata(doc, relay=None):
     """Parser completo cedolino con tutti i dettagli."""
     prompt = """
 Questo è un CEDOLINO PAGA GOTTARDO S.p.A. italiano. Estrai ESATTAMENTE:
@@ -315,27 +1558,57 @@ Output SOLO JSON:
 }
 """.strip()
 
-    result = analyze_with_fallback(path, prompt, "Busta Paga")
+    relay = relay or ProgressRelay(immediate=True)
+    cache_key = ai_cache_key("busta", doc, prompt)
+    cached = ai_cache_get(cache_key)
+    if cached:
+        relay.status("Busta Paga", "success", "⚡ Busta Paga già analizzata (cache)")
+        return cached
+
+    # Fast path locale: il modello serve solo per i campi non trovati
+    local, missing = parse_busta_locale(doc)
+    if local and not missing:
+        relay.status("Busta Paga", "success", "⚡ Busta Paga letta in locale")
+        return local
+
+    result = analyze_with_fallback(doc, prompt, "Busta Paga", relay)
     if not result:
-        return {
-            "e_tredicesima": False,
-            "dati_generali": {"netto": 0, "giorni_pagati": 0, "ore_ordinarie": 0},
-            "competenze": {
-                "base": 0,
-                "anzianita": 0,
-                "straordinari": 0,
-                "festivita": 0,
-                "lordo_totale": 0,
-            },
-            "trattenute": {"inps": 0, "irpef_netta": 0, "addizionali": 0},
-            "ferie": {"residue_ap": 0, "maturate": 0, "godute": 0, "saldo": 0},
-            "par": {"residue_ap": 0, "spettanti": 0, "fruite": 0, "saldo": 0},
-            "assenze_mese": {"ore_ferie": 0, "ore_permessi": 0, "ore_malattia": 0},
-        }
+        return local or empty_busta()
+
+    if local:
+        # I valori trovati in locale sono deterministici: hanno la precedenza
+        for sec, fields in local.items():
+            if not isinstance(fields, dict):
+                continue
+            if not isinstance(result.get(sec), dict):
+                result[sec] = {}
+            for key, val in fields.items():
+                if (sec, key) not in missing:
+                    result[sec][key] = val
+    ai_cache_put(cache_key, result)
     return result
 
 
-def parse_cartellino_dettagliato(path):
+def empty_busta():
+    """Schema della busta con tutti i valori a zero."""
+    return {
+        "e_tredicesima": False,
+        "dati_generali": {"netto": 0, "giorni_pagati": 0, "ore_ordinarie": 0},
+        "competenze": {
+            "base": 0,
+            "anzianita": 0,
+            "straordinari": 0,
+            "festivita": 0,
+            "lordo_totale": 0,
+        },
+        "trattenute": {"inps": 0, "irpef_netta": 0, "addizionali": 0},
+        "ferie": {"residue_ap": 0, "maturate": 0, "godute": 0, "saldo": 0},
+        "par": {"residue_ap": 0, "spettanti": 0, "fruite": 0, "saldo": 0},
+        "assenze_mese": {"ore_ferie": 0, "ore_permessi": 0, "ore_malattia": 0},
+    }
+
+
+def parse_cartellino_dettagliato(doc, relay=None):
     """Parser completo cartellino presenze."""
     prompt = """
     Analizza questo CARTELLINO PRESENZE GOTTARDO S.p.A.
@@ -375,7 +1648,25 @@ def parse_cartellino_dettagliato(path):
     }
     """.strip()
 
-    result = analyze_with_fallback(path, prompt, "Cartellino")
+    relay = relay or ProgressRelay(immediate=True)
+    # Parser di riga locale prima della cache: pochi ms e ha il dettaglio per
+    # giorno, che i risultati del modello in cache non hanno
+    local = parse_cartellino_locale(doc)
+    if local:
+        relay.status(
+            "Cartellino",
+            "success",
+            f"⚡ Cartellino letto in locale ({len(local['giorni_dettaglio'])} giorni)",
+        )
+        return local
+
+    cache_key = ai_cache_key("cartellino", doc, prompt)
+    cached = ai_cache_get(cache_key)
+    if cached:
+        relay.status("Cartellino", "success", "⚡ Cartellino già analizzato (cache)")
+        return cached
+
+    result = analyze_with_fallback(doc, prompt, "Cartellino", relay)
     if not result:
         return {
             "giorni_lavorati": 0,
@@ -396,19 +1687,378 @@ def parse_cartellino_dettagliato(path):
         result["giorni_lavorati"] = result["giorni_footer"]
     elif result.get("giorni_righe", 0) > 0:
         result["giorni_lavorati"] = result["giorni_righe"]
-        
+
+    ai_cache_put(cache_key, result)
     return result
 
 
+# ==============================================================================
+# ATTESE SU CONDIZIONI (AL POSTO DEI time.sleep FISSI)
+# ==============================================================================
+# Tetto massimo (ms) per tipo di step: si prosegue appena la condizione è vera
+WAIT_BUDGETS = {
+    "input": 1500,  # Validazione campi, chiusura popup
+    "mini_cal": 3000,  # Mini-calendario dijit
+    "menu": 6000,  # Menu principale / tab
+    "calendar": 8000,  # Caricamento vista calendario ed eventi
+    "page": 12000,  # Pagine e tab con contenuto
+    "search": 15000,  # Ricerca cartellino
+    "login": 15000,
+    "popup": 15000,
+    "download": 25000,
+}
+
+# Si risolve dopo quietMs senza mutazioni del DOM (false se scade maxMs)
+DOM_STABLE_JS = """
+([quietMs, maxMs]) => new Promise((resolve) => {
+    let quiet = null;
+    let cap = null;
+    const done = (stable) => {
+        obs.disconnect();
+        clearTimeout(quiet);
+        clearTimeout(cap);
+        resolve(stable);
+    };
+    const obs = new MutationObserver(() => {
+        clearTimeout(quiet);
+        quiet = setTimeout(() => done(true), quietMs);
+    });
+    obs.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    quiet = setTimeout(() => done(true), quietMs);
+    cap = setTimeout(() => done(false), maxMs);
+})
+"""
+
+
+class StepWaiter:
+    """
+    Attende condizioni concrete (selettore, risposta di rete, DOM stabile,
+    URL, download) con un tetto per step e registra quanto è durata ogni attesa.
+    """
+
+    def __init__(self):
+        self.timings = []  # [{"step", "tipo", "secondi", "ok"}]
+        self.blocked = {"richieste": 0, "byte": 0}  # Risorse non scaricate (stima)
+        self._lock = threading.Lock()
+
+    def add_blocked(self, delta):
+        """Somma le risorse bloccate da un ramo (le corsie girano in parallelo)."""
+        with self._lock:
+            for k, v in delta.items():
+                self.blocked[k] += v
+
+    def _record(self, step, kind, t0, ok):
+        self.timings.append(
+            {
+                "step": step,
+                "tipo": kind,
+                "secondi": round(time.perf_counter() - t0, 2),
+                "ok": ok,
+            }
+        )
+        return ok
+
+    def selector(self, target, selector, step, budget="page", state="visible"):
+        """Page o Frame: attende il selettore (False se scade il tetto)."""
+        t0 = time.perf_counter()
+        try:
+            target.wait_for_selector(
+                selector, state=state, timeout=WAIT_BUDGETS[budget]
+            )
+            return self._record(step, "selettore", t0, True)
+        except Exception:
+            return self._record(step, "selettore", t0, False)
+
+    def dom_stable(self, target, step, budget="menu", quiet_ms=400):
+        """Page o Frame: attende che il DOM smetta di cambiare per quiet_ms."""
+        t0 = time.perf_counter()
+        try:
+            ok = bool(target.evaluate(DOM_STABLE_JS, [quiet_ms, WAIT_BUDGETS[budget]]))
+        except Exception:
+            ok = False
+        return self._record(step, "dom", t0, ok)
+
+    def response(self, page, url_regex, action, step, budget="calendar"):
+        """Esegue action() e attende una risposta di rete con URL compatibile."""
+        pattern = re.compile(url_regex, re.I)
+        PlaywrightTimeoutError = lazy_import("playwright.sync_api", "TimeoutError")
+        t0 = time.perf_counter()
+        try:
+            with page.expect_response(
+                lambda r: bool(pattern.search(r.url)), timeout=WAIT_BUDGETS[budget]
+            ):
+                action()
+        except PlaywrightTimeoutError:
+            return self._record(step, "rete", t0, False)
+        return self._record(step, "rete", t0, True)
+
+    def url(self, page, url_regex, step, budget="popup"):
+        """Attende che la pagina (es. un popup) navighi verso un URL compatibile."""
+        t0 = time.perf_counter()
+        try:
+            page.wait_for_url(
+                re.compile(url_regex), wait_until="commit", timeout=WAIT_BUDGETS[budget]
+            )
+            return self._record(step, "url", t0, True)
+        except Exception:
+            return self._record(step, "url", t0, False)
+
+    def until(self, predicate, step, budget="menu", poll=0.1):
+        """Condizione lato Python (es. comparsa di un frame), con polling breve."""
+        t0 = time.perf_counter()
+        deadline = t0 + WAIT_BUDGETS[budget] / 1000
+        while True:
+            try:
+                value = predicate()
+                if value:
+                    self._record(step, "condizione", t0, True)
+                    return value
+            except Exception:
+                pass
+            if time.perf_counter() >= deadline:
+                self._record(step, "condizione", t0, False)
+                return None
+            time.sleep(poll)
+
+    @contextmanager
+    def timed(self, step, kind="download"):
+        """Misura un blocco che contiene già la sua attesa (es. expect_download)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._record(step, kind, t0, False)
+            raise
+        self._record(step, kind, t0, True)
+
+
 # ==============================================================================
 # AGENDA - METODO MIGLIORATO CON INTERCETTAZIONE RETE
 # ==============================================================================
-def read_agenda_with_navigation(page, context, mese_num, anno):
+# Raccolta DOM in un solo round trip: celle del mese corrente e nodi evento.
+# Un nodo corrisponde a una keyword come per il selettore text= di Playwright:
+# contiene il testo (senza distinzione maiuscole) e nessun figlio lo contiene.
+AGENDA_HARVEST_JS = """
+([kws, cellSelectors]) => {
+    const visible = (el) => {
+        const r = el.getBoundingClientRect();
+        if (!r.width || !r.height) return false;
+        const s = getComputedStyle(el);
+        return s.visibility !== 'hidden' && s.display !== 'none';
+    };
+    const rect = (el) => {
+        const r = el.getBoundingClientRect();
+        return {x: r.x, y: r.y, width: r.width, height: r.height};
+    };
+
+    let root = document.querySelector('#calendarContainer, #calendarUI_ExtendedCalendar_0');
+    const grid = !!root && visible(root);
+    if (!grid) root = document.body;
+
+    const cells = [];
+    for (const sel of cellSelectors) {
+        let found = [];
+        try { found = root.querySelectorAll(sel); } catch (e) { continue; }
+        for (const c of found) {
+            if (!visible(c)) continue;
+            const m = (c.innerText || '').match(/^\\s*(\\d{1,2})\\b/);
+            cells.push({...rect(c), day: m ? parseInt(m[1], 10) : null});
+        }
+        if (cells.length >= 28) break;  // Minimo 28 giorni in un mese
+    }
+
+    const skip = new Set(['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE']);
+    const texts = new Map();
+    const all = root.querySelectorAll('*');
+    for (const el of all) {
+        if (!skip.has(el.tagName)) {
+            texts.set(el, (el.textContent || '').replace(/\\s+/g, ' ').toUpperCase());
+        }
+    }
+    const nodes = [];
+    for (const el of all) {
+        const t = texts.get(el);
+        if (!t) continue;
+        const hits = kws.filter((k) => t.includes(k)
+            && ![...el.children].some((ch) => (texts.get(ch) || '').includes(k)));
+        if (!hits.length || !visible(el)) continue;
+        nodes.push({...rect(el), text: el.innerText || '', kws: hits});
+    }
+    return {grid, cells, nodes};
+}
+"""
+
+
+class CellGrid:
+    """
+    Indice a griglia dei rettangoli delle celle: ogni bucket (step px) conosce
+    le celle che lo toccano, così un punto si verifica su poche celle
+    invece che su tutte.
+    """
+
+    def __init__(self, cells, step=40):
+        self.cells = cells
+        self.step = step
+        self._buckets = {}
+        for i, c in enumerate(cells):
+            for bx in range(int(c["x"] // step), int((c["x"] + c["width"]) // step) + 1):
+                for by in range(
+                    int(c["y"] // step), int((c["y"] + c["height"]) // step) + 1
+                ):
+                    self._buckets.setdefault((bx, by), []).append(i)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def find(self, x, y):
+        """Cella che contiene il punto (x, y), None se fuori dal mese."""
+        for i in self._buckets.get((int(x // self.step), int(y // self.step)), []):
+            c = self.cells[i]
+            if c["x"] <= x <= c["x"] + c["width"] and c["y"] <= y <= c["y"] + c["height"]:
+                return c
+        return None
+
+
+# Widget calendario (dojox.calendar) dell'iframe agenda: lettura della data
+# corrente o salto diretto a un mese con la sua API JS, senza mini-calendario
+CALENDAR_WIDGET_JS = """
+([action, year, month]) => {
+    const reg = window.dijit && (dijit.registry || dijit);
+    if (!reg || !reg.byId) return null;
+    let cal = reg.byId('calendarUI_ExtendedCalendar_0');
+    if (!cal && reg.toArray) {
+        cal = reg.toArray().find((w) => /calendar/i.test(w.declaredClass || '')
+            && typeof w.set === 'function' && w.get && w.get('date') instanceof Date);
+    }
+    if (!cal) return null;
+    if (action === 'set') {
+        if (cal.get('dateInterval') !== undefined) cal.set('dateInterval', 'month');
+        cal.set('date', new Date(year, month - 1, 15));
+    }
+    const d = cal.get('date');
+    return {
+        widget: cal.id,
+        year: d.getFullYear(),
+        month: d.getMonth() + 1,
+        interval: cal.get('dateInterval') || null,
+    };
+}
+"""
+
+
+def goto_agenda_month(page, frame, mese_num, anno, waiter, debug):
+    """
+    Porta il calendario al mese target con l'API del widget (vista mensile +
+    set('date')): costo costante, indipendente da quanto è lontano il mese.
+    False se il widget non è raggiungibile: si usa la navigazione a click.
+    """
+    try:
+        state = frame.evaluate(CALENDAR_WIDGET_JS, ["get", anno, mese_num])
+    except Exception:
+        state = None
+    if not state:
+        debug.append("  ⚠️ Widget calendario non accessibile da JS, uso i click")
+        return False
+
+    on_target = (state["year"], state["month"]) == (anno, mese_num)
+    if not (on_target and state["interval"] in (None, "month")):
+        # Il cambio data ricarica gli eventi del mese (catturati dal listener)
+        try:
+            waiter.response(
+                page,
+                r"events|anomalies",
+                lambda: frame.evaluate(CALENDAR_WIDGET_JS, ["set", anno, mese_num]),
+                "agenda: salto diretto al mese",
+            )
+            state = frame.evaluate(CALENDAR_WIDGET_JS, ["get", anno, mese_num]) or {}
+        except Exception as e:
+            debug.append(f"  ⚠️ Errore widget calendario ({e}), uso i click")
+            return False
+
+    if (state.get("year"), state.get("month")) != (anno, mese_num):
+        debug.append(f"  ⚠️ Salto diretto non riuscito ({state}), uso i click")
+        return False
+    debug.append(f"  ⚡ Mese impostato via widget {state['widget']}: {mese_num}/{anno}")
+    return True
+
+
+AGENDA_LABELS = {
+    "OMESSA TIMBRATURA": "⚠️ OMESSA",
+    "FERIE": "🏖️ FERIE",
+    "MALATTIA": "🤒 MALATTIA",
+    "RIPOSO": "💤 RIPOSO",
+}
+
+
+class AgendaLedger:
+    """
+    Eventi agenda di un mese per giorno: giorno -> {codice normalizzato:
+    {"fonti", "summary"}}. Lo stesso evento visto da rete, API e DOM conta una
+    volta sola. Gli eventi senza giorno (DOM senza griglia) contano solo oltre
+    quelli già datati con lo stesso codice.
+    """
+
+    def __init__(self):
+        self.days = {}
+        self._undated = {}  # codice -> [summary]
+
+    def add(self, day, code, source, summary=""):
+        if not day:
+            self._undated.setdefault(code, []).append(summary)
+            return
+        entry = self.days.setdefault(day, {}).setdefault(
+            code, {"fonti": set(), "summary": summary}
+        )
+        entry["fonti"].add(source)
+        entry["summary"] = entry["summary"] or summary
+
+    def counts(self):
+        """Eventi per codice (formato events_by_type)."""
+        counts = {}
+        for codes in self.days.values():
+            for code in codes:
+                counts[code] = counts.get(code, 0) + 1
+        for code, summaries in self._undated.items():
+            counts[code] = counts.get(code, 0) + max(
+                0, len(summaries) - counts.get(code, 0)
+            )
+        return counts
+
+    def items(self):
+        out = []
+        for day in sorted(self.days):
+            for code, e in self.days[day].items():
+                out.append(f"{AGENDA_LABELS.get(code, code)} ({day}): {e['summary'][:50]}")
+        for code, summaries in self._undated.items():
+            out += [f"{AGENDA_LABELS.get(code, code)}: {s[:50]}" for s in summaries]
+        return out
+
+    def to_dict(self):
+        """giorno -> {codice: {"fonti": [...], "summary"}}, per session_state."""
+        return {
+            day: {
+                code: {"fonti": sorted(e["fonti"]), "summary": e["summary"]}
+                for code, e in codes.items()
+            }
+            for day, codes in sorted(self.days.items())
+        }
+
+    def fill(self, result):
+        """Completa un risultato agenda con conteggi, elenco e giorni."""
+        result["events_by_type"] = self.counts()
+        result["total_events"] = sum(result["events_by_type"].values())
+        result["items"] = self.items()
+        result["giorni"] = self.to_dict()
+        return result
+
+
+def read_agenda_with_navigation(page, context, mese_num, anno, waiter=None):
     """
     Legge l'agenda navigando effettivamente al calendario e intercettando le richieste.
     Questo è più affidabile delle chiamate API dirette.
     """
     result = {"events_by_type": {}, "total_events": 0, "items": [], "debug": []}
+    waiter = waiter or StepWaiter()
 
     captured_events = []
 
@@ -459,7 +2109,7 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                 result["debug"].append("  Menu Time cliccato (locator)")
             except:
                 result["debug"].append("  ⚠️ Menu Time non trovato")
-        time.sleep(3)
+        waiter.dom_stable(page, "agenda: menu Time", "menu")
 
         # 2) Cerca il pannello/tab del calendario - vari tentativi
         # Guardando lo screenshot: "Mese" è un tab che mostra la vista calendario
@@ -488,18 +2138,33 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                 except:
                     pass
 
-        time.sleep(4)
-
         # === CATTURA EVENTI DAL DOM (DENTRO IFRAME) ===
         result["debug"].append("🔍 Ricerca eventi nell'IFRAME del calendario...")
 
-        # Cerca il frame del calendario
-        calendar_frame = None
-        for frame in page.frames:
-            if "CalUI" in frame.name or "calendar" in frame.url:
-                calendar_frame = frame
-                result["debug"].append(f"  ✅ Frame calendario trovato: {frame.name}")
-                break
+        # Attende il frame del calendario (al posto di un'attesa fissa)
+        calendar_frame = waiter.until(
+            lambda: next(
+                (
+                    f
+                    for f in page.frames
+                    if "CalUI" in f.name or "calendar" in f.url
+                ),
+                None,
+            ),
+            "agenda: frame calendario",
+            "calendar",
+        )
+        if calendar_frame:
+            result["debug"].append(
+                f"  ✅ Frame calendario trovato: {calendar_frame.name}"
+            )
+            waiter.selector(
+                calendar_frame,
+                ".dijitButtonText",
+                "agenda: toolbar calendario",
+                "calendar",
+                state="attached",
+            )
 
         # Se non trova il frame specifico, usa il main frame ma cerca anche negli altri
         target_frames = [calendar_frame] if calendar_frame else page.frames
@@ -512,6 +2177,12 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
 
         cal_nav_success = False
         if calendar_frame:
+            cal_nav_success = goto_agenda_month(
+                page, calendar_frame, mese_num, anno, waiter, result["debug"]
+            )
+
+        # Fallback: vista "Mese" e frecce del mini-calendario
+        if calendar_frame and not cal_nav_success:
             try:
                 # 0. FORZA VISTA MENSILE (CRITICO!)
                 # Cerca e clicca il bottone "Mese" nella toolbar principale
@@ -543,7 +2214,7 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                     except:
                         result["debug"].append("  ⚠️ Bottone 'Mese' non trovato")
 
-                time.sleep(2)  # Attesa cambio vista
+                waiter.dom_stable(calendar_frame, "agenda: vista mese", "calendar")
 
                 # === NUOVA NAVIGAZIONE: USA FRECCE PRINCIPALI TOOLBAR (NO SIDEBAR) ===
                 # 1. Assicurati Vista MENSILE
@@ -556,7 +2227,9 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                         if month_btns.nth(i).is_visible():
                             try:
                                 month_btns.nth(i).click()
-                                time.sleep(2)
+                                waiter.dom_stable(
+                                    calendar_frame, "agenda: vista mese (2)", "calendar"
+                                )
                                 break
                             except:
                                 pass
@@ -669,12 +2342,15 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                                 f"  🖱️ Clicco candidato visibile: {btn.get_attribute('class')}..."
                             )
                             btn.click()
-                            time.sleep(2.0)
 
                             # Verifica se si è aperto
-                            if calendar_frame.locator(
-                                ".dijitCalendar, .dijitCalendarPopup"
-                            ).last.is_visible():
+                            if waiter.selector(
+                                calendar_frame,
+                                ".dijitCalendar:visible, .dijitCalendarPopup:visible",
+                                "agenda: apertura mini-calendario",
+                                "mini_cal",
+                                state="attached",
+                            ):
                                 opened_popup = True
                                 break
                     except:
@@ -689,10 +2365,13 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                         calendar_frame.locator(
                             f"text={current_title_text}"
                         ).first.click()
-                        time.sleep(2.0)
-                        if calendar_frame.locator(
-                            ".dijitCalendar, .dijitCalendarPopup"
-                        ).last.is_visible():
+                        if waiter.selector(
+                            calendar_frame,
+                            ".dijitCalendar:visible, .dijitCalendarPopup:visible",
+                            "agenda: mini-calendario da titolo",
+                            "mini_cal",
+                            state="attached",
+                        ):
                             opened_popup = True
                     except:
                         pass
@@ -803,7 +2482,13 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                                     result["debug"].append(
                                         f"    ⚠️ Bottone Blind {arrow_sel} NON VISIBILE"
                                     )
-                                time.sleep(0.4)  # Click rapidi
+                                # Il dijit aggiorna la griglia in modo sincrono
+                                waiter.dom_stable(
+                                    calendar_frame,
+                                    f"agenda: freccia {moves + 1}",
+                                    "mini_cal",
+                                    quiet_ms=100,
+                                )
                                 moves += 1
                                 continue
                             else:
@@ -819,11 +2504,16 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                                 if len(days) > 0:
                                     idx = min(15, len(days) - 1)
                                     try:
-                                        days[idx].click()
+                                        # Il click ricarica gli eventi del mese
+                                        waiter.response(
+                                            page,
+                                            r"events|anomalies",
+                                            days[idx].click,
+                                            "agenda: eventi mese target",
+                                        )
                                         result["debug"].append(
                                             f"    🖱️ Click giorno {idx + 1}"
                                         )
-                                        time.sleep(4)
                                         cal_nav_success = True
                                     except:
                                         pass
@@ -858,71 +2548,18 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                 # Url check: siamo ancora sull'agenda?
                 # Aspetta body visible
                 calendar_frame.locator("body").wait_for(timeout=2000)
-                time.sleep(2)  # Rendering finale
-
-                # 1. Prova prima griglia specifica (più accurata)
-                grid = calendar_frame.locator(
-                    "#calendarContainer, #calendarUI_ExtendedCalendar_0"
-                ).first
-
-                search_area = (
-                    grid if grid.is_visible() else calendar_frame.locator("body")
+                waiter.dom_stable(
+                    calendar_frame, "agenda: rendering finale", "calendar"
                 )
-                src_name = "Griglia" if grid.is_visible() else "BODY (Fallback)"
-                result["debug"].append(f"  Target scraping: {src_name}")
-
-                # 2. Cerca Keyword
-                keywords = [
-                    "OMESSA",
-                    "OMT",
-                    "FERIE",
-                    "FEP",
-                    "MALATTIA",
-                    "MAL",
-                    "RIPOSO",
-                    "RCS",
-                    "RIC",
-                    "RPS",
-                ]
-
-                # Dizionario per evitare duplicati (stesso evento letto più volte)
-                # Chiave = testo + posizione approx? No, conteggio semplice per ora.
 
                 # STRATEGIA GEOMETRICA WHITELIST
                 # Invece di cercare le celle "bad", cerchiamo le celle "GOOD" (mese corrente)
                 # e accettiamo SOLO gli eventi che cadono sopra di esse.
-                allowed_boxes = []
-                try:
-                    # Prova diversi selettori per le celle del mese corrente
-                    cell_selectors = [
-                        ".dijitCalendarCurrentMonth",
-                        "td:not(.dijitCalendarPreviousMonth):not(.dijitCalendarNextMonth)",
-                        "td[style*='background']:not([style*='gray'])",
-                    ]
-                    
-                    for sel in cell_selectors:
-                        try:
-                            cells = search_area.locator(sel).all()
-                            for c in cells:
-                                if c.is_visible():
-                                    b = c.bounding_box()
-                                    if b:
-                                        allowed_boxes.append(b)
-                            if len(allowed_boxes) >= 28:  # Minimo 28 giorni in un mese
-                                break
-                        except:
-                            continue
-
-                    result["debug"].append(
-                        f"  ✅ Mappate {len(allowed_boxes)} celle giorni mese corrente"
-                    )
-                except:
-                    pass
-
-                # Nomi dei mesi per il filtro testuale (escludere eventi che menzionano altri mesi)
-                mese_nome_corrente = MESI_IT[mese_num - 1]  # es: "Ottobre" per mese_num=10
-                altri_mesi = [m.lower()[:3] for m in MESI_IT if m.lower()[:3] != mese_nome_corrente.lower()[:3]]
-                mese_corrente_short = mese_nome_corrente.lower()[:3]  # es: "ott" per Ottobre
+                cell_selectors = [
+                    ".dijitCalendarCurrentMonth",
+                    "td:not(.dijitCalendarPreviousMonth):not(.dijitCalendarNextMonth)",
+                    "td[style*='background']:not([style*='gray'])",
+                ]
 
                 # Loop completo keywords (esteso con MANCATA/ANOMALIA)
                 all_kws = [
@@ -940,82 +2577,85 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
                     "RPS",
                     "REC",
                 ]
-                for kw in all_kws:
-                    # text=KW è case-insensitive
-                    matches = search_area.locator(f"text={kw}")
-                    count = matches.count()
 
+                # Griglia (o body), celle e nodi evento in un solo evaluate
+                t_harvest = time.perf_counter()
+                harvest = calendar_frame.evaluate(
+                    AGENDA_HARVEST_JS, [all_kws, cell_selectors]
+                )
+                src_name = "Griglia" if harvest["grid"] else "BODY (Fallback)"
+                result["debug"].append(f"  Target scraping: {src_name}")
+                result["debug"].append(
+                    f"  ⏱️ {len(harvest['nodes'])} nodi candidati in "
+                    f"{(time.perf_counter() - t_harvest) * 1000:.0f} ms"
+                )
+
+                # Se non ci sono celle (es. scraping body fallback senza griglia) il filtro
+                # è disattivato per sicurezza; se ne abbiamo trovate (es. 31) è ATTIVO.
+                allowed_cells = CellGrid(harvest["cells"])
+                result["debug"].append(
+                    f"  ✅ Mappate {len(allowed_cells)} celle giorni mese corrente"
+                )
+
+                # Nomi dei mesi per il filtro testuale (escludere eventi che menzionano altri mesi)
+                mese_nome_corrente = MESI_IT[mese_num - 1]  # es: "Ottobre" per mese_num=10
+                altri_mesi = [m.lower()[:3] for m in MESI_IT if m.lower()[:3] != mese_nome_corrente.lower()[:3]]
+
+                for kw in all_kws:
                     real_matches = 0
-                    for i in range(count):
-                        try:
-                            el = matches.nth(i)
-                            if not el.is_visible():
-                                continue
+                    for node in harvest["nodes"]:
+                        if kw not in node["kws"]:
+                            continue
 
-                            # 1. FILTRI TESTUALI (ANTI-SIDEBAR)
-                            txt_upper = el.inner_text().upper()
-                            txt_lower = el.inner_text().lower()
-                            if "SALDO" in txt_upper or "RESIDUO" in txt_upper:
-                                continue
-                            if "TOTALE" in txt_upper or "PERMESSI DEL" in txt_upper:
-                                continue
-                            
-                            # 1b. FILTRO DATE ALTRI MESI
-                            # Escludi eventi che contengono date di altri mesi (es. "29 set", "1 nov")
-                            skip_wrong_month = False
-                            for altro_mese in altri_mesi:
-                                if altro_mese in txt_lower:
-                                    skip_wrong_month = True
-                                    break
-                            if skip_wrong_month:
-                                result["debug"].append(f"    Scartato evento fuori mese: {txt_lower[:40]}...")
-                                continue
+                        # 1. FILTRI TESTUALI (ANTI-SIDEBAR)
+                        txt_upper = node["text"].upper()
+                        txt_lower = node["text"].lower()
+                        if "SALDO" in txt_upper or "RESIDUO" in txt_upper:
+                            continue
+                        if "TOTALE" in txt_upper or "PERMESSI DEL" in txt_upper:
+                            continue
 
-                            # 2. FILTRI GEOMETRICI
-                            box = el.bounding_box()
-                            if not box:
-                                continue
+                        # 1b. FILTRO DATE ALTRI MESI
+                        # Escludi eventi che contengono date di altri mesi (es. "29 set", "1 nov")
+                        if any(altro_mese in txt_lower for altro_mese in altri_mesi):
+                            result["debug"].append(f"    Scartato evento fuori mese: {txt_lower[:40]}...")
+                            continue
 
-                            # a) Sidebar a sinistra
-                            if box["x"] < 300:
-                                continue
+                        # 2. FILTRI GEOMETRICI
+                        # a) Sidebar a sinistra
+                        if node["x"] < 300:
+                            continue
 
-                            # b) WHITELIST CHECK: Deve sovrapporsi a una cella del mese corrente
-                            # Se allowed_boxes è vuoto (es. scraping body fallback senza griglia), disabilitiamo il filtro per sicurezza
-                            # Ma se ne abbiamo trovate (es. 31), allora il filtro è ATTIVO.
-                            if allowed_boxes:
-                                is_good = False
-                                cx = box["x"] + box["width"] / 2
-                                cy = box["y"] + box["height"] / 2
-                                for gbox in allowed_boxes:
-                                    if (
-                                        gbox["x"] <= cx <= gbox["x"] + gbox["width"]
-                                    ) and (
-                                        gbox["y"] <= cy <= gbox["y"] + gbox["height"]
-                                    ):
-                                        is_good = True
-                                        break
-                                if not is_good:
-                                    # result["debug"].append(f"    Scartato '{kw}' fuori dai giorni del mese")
-                                    continue
-
-                            real_matches += 1
-                            if "OMESSA" in kw or "OMT" in kw:
-                                dom_events.append("OMESSA TIMBRATURA")
-                            elif "FERIE" in kw or "FEP" in kw:
-                                dom_events.append("FERIE")
-                            elif "MALATTIA" in kw or "MAL" in kw:
-                                dom_events.append("MALATTIA")
-                            elif (
-                                "RIPOSO" in kw
-                                or "RCS" in kw
-                                or "RIC" in kw
-                                or "RPS" in kw
-                            ):
-                                dom_events.append("RIPOSO")
+                        # b) WHITELIST CHECK: il centro deve cadere in una cella del mese corrente
+                        cell = None
+                        if allowed_cells:
+                            cell = allowed_cells.find(
+                                node["x"] + node["width"] / 2,
+                                node["y"] + node["height"] / 2,
+                            )
+                            if cell is None:
+                                continue
 
-                        except:
-                            pass
+                        if "OMESSA" in kw or "OMT" in kw:
+                            kind = "OMESSA TIMBRATURA"
+                        elif "FERIE" in kw or "FEP" in kw:
+                            kind = "FERIE"
+                        elif "MALATTIA" in kw or "MAL" in kw:
+                            kind = "MALATTIA"
+                        elif "RIPOSO" in kw or "RCS" in kw or "RIC" in kw or "RPS" in kw:
+                            kind = "RIPOSO"
+                        else:
+                            kind = None
+
+                        real_matches += 1
+                        if kind:
+                            dom_events.append(
+                                {
+                                    "summary": kind,
+                                    "giorno": cell["day"] if cell else None,
+                                    "fonte": "dom",
+                                }
+                            )
 
                     if real_matches > 0:
                         result["debug"].append(
@@ -1044,8 +2684,10 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
         except:
             pass
 
-    # Processa eventi catturati
-    all_events = captured_events + [{"summary": e} for e in dom_events]
+    # Processa eventi catturati: un registro per giorno, senza doppioni tra fonti
+    ledger = AgendaLedger()
+    all_events = [dict(ev, fonte="rete") for ev in captured_events if isinstance(ev, dict)]
+    all_events += dom_events
 
     for ev in all_events:
         summary = str(
@@ -1058,13 +2700,15 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
         if "PERMESSI DEL" in summary:
             continue
 
-        # Filtra per mese (se c'è data)
+        # Filtra per mese (se c'è data) e ricava il giorno
+        day = ev.get("giorno")
         start = ev.get("startTime", "") or ev.get("start", "") or ev.get("date", "")
         if start and len(str(start)) >= 7:
             try:
                 ev_month = int(str(start)[5:7])
                 if ev_month != mese_num:
                     continue
+                day = int(str(start)[8:10])
             except:
                 pass
 
@@ -1078,20 +2722,11 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
         )
 
         if is_omessa:
-            result["events_by_type"]["OMESSA TIMBRATURA"] = (
-                result["events_by_type"].get("OMESSA TIMBRATURA", 0) + 1
-            )
-            result["items"].append(f"⚠️ OMESSA: {summary[:50]}")
+            code = "OMESSA TIMBRATURA"
         elif "FERIE" in summary_norm or "FEP" in summary_norm:
-            result["events_by_type"]["FERIE"] = (
-                result["events_by_type"].get("FERIE", 0) + 1
-            )
-            result["items"].append(f"🏖️ FERIE: {summary[:50]}")
+            code = "FERIE"
         elif "MALATTIA" in summary or "MAL" in summary:
-            result["events_by_type"]["MALATTIA"] = (
-                result["events_by_type"].get("MALATTIA", 0) + 1
-            )
-            result["items"].append(f"🤒 MALATTIA: {summary[:50]}")
+            code = "MALATTIA"
         elif (
             "RIPOSO" in summary
             or "RCS" in summary
@@ -1099,435 +2734,1455 @@ def read_agenda_with_navigation(page, context, mese_num, anno):
             or "RPS" in summary
             or "REC" in summary
         ):
-            result["events_by_type"]["RIPOSO"] = (
-                result["events_by_type"].get("RIPOSO", 0) + 1
+            code = "RIPOSO"
+        else:
+            continue
+        ledger.add(day, code, ev.get("fonte", "rete"), summary)
+
+    ledger.fill(result)
+    result["debug"].append(f"📊 Totale categorizzati: {result['total_events']}")
+    result["success"] = True  # Flag Esplicito di Successo
+
+    return result
+
+
+class AgendaYearCache:
+    """
+    Eventi agenda di un anno intero per (utente, anno), indicizzati per mese
+    e giorno. L'API restituisce comunque l'anno: gli altri mesi escono dalla
+    cache senza chiamate. I mesi chiusi restano validi AGENDA_YEAR_TTL, il mese
+    in corso (e i successivi) solo AGENDA_CURRENT_TTL e vengono riletti da soli.
+    Accanto all'indice API tiene il risultato finale di read_agenda per mese
+    (navigazione + API): una hit restituisce esattamente quello di una miss.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (utente, anno) -> {"fetched": ts anno intero, "months": {mese: {"fetched", "days"}}}
+        self._years = {}
+        # (utente, anno, mese) -> {"fetched", "agenda"}
+        self._results = {}
+
+    @staticmethod
+    def _key(user, anno):
+        return (hashlib.sha256(user.encode()).hexdigest()[:16], anno)
+
+    @staticmethod
+    def _ttl(mese_num, anno):
+        oggi = time.localtime()
+        if (anno, mese_num) >= (oggi.tm_year, oggi.tm_mon):
+            return AGENDA_CURRENT_TTL
+        return AGENDA_YEAR_TTL
+
+    def month(self, user, anno, mese_num):
+        """Indice giorno -> [(codice, summary)] del mese, None se assente o scaduto."""
+        with self._lock:
+            entry = self._years.get(self._key(user, anno))
+            month = entry and entry["months"].get(mese_num)
+        if not month or time.time() - month["fetched"] > self._ttl(mese_num, anno):
+            return None
+        return month["days"]
+
+    def result(self, user, anno, mese_num):
+        """Copia dell'agenda finale del mese, None se assente o scaduta."""
+        with self._lock:
+            entry = self._results.get(self._key(user, anno) + (mese_num,))
+        if not entry or time.time() - entry["fetched"] > self._ttl(mese_num, anno):
+            return None
+        agenda = copy.deepcopy(entry["agenda"])
+        agenda["debug"] = ["⚡ Agenda dalla cache (risultato completo)"] + agenda["debug"]
+        return agenda
+
+    def put_result(self, user, anno, mese_num, agenda):
+        with self._lock:
+            self._results[self._key(user, anno) + (mese_num,)] = {
+                "fetched": time.time(),
+                "agenda": copy.deepcopy(agenda),
+            }
+
+    def has_year(self, user, anno):
+        """True se l'anno intero è stato letto entro AGENDA_YEAR_TTL."""
+        with self._lock:
+            entry = self._years.get(self._key(user, anno))
+        return bool(entry) and time.time() - entry["fetched"] <= AGENDA_YEAR_TTL
+
+    def put(self, user, anno, mesi, index):
+        """Salva i mesi letti (anche vuoti: nessun evento è un dato valido)."""
+        now = time.time()
+        with self._lock:
+            entry = self._years.setdefault(
+                self._key(user, anno), {"fetched": 0, "months": {}}
+            )
+            if len(mesi) == 12:
+                entry["fetched"] = now
+            for m in mesi:
+                entry["months"][m] = {"fetched": now, "days": index.get(m, {})}
+            # Anni scaduti da tempo: fuori dalla memoria
+            for key in [
+                k for k, e in self._years.items() if now - e["fetched"] > 2 * AGENDA_YEAR_TTL
+            ]:
+                if key != self._key(user, anno):
+                    del self._years[key]
+            for key in [
+                k for k, e in self._results.items() if now - e["fetched"] > AGENDA_YEAR_TTL
+            ]:
+                del self._results[key]
+
+
+@st.cache_resource
+def get_agenda_cache():
+    return AgendaYearCache()
+
+
+@st.cache_resource
+def get_agenda_executor():
+    """Thread per le chiamate API agenda (una per codice calendario)."""
+    return ThreadPoolExecutor(
+        max_workers=len(CALENDAR_CODES), thread_name_prefix="agenda"
+    )
+
+
+def _agenda_get_concurrent(context, urls):
+    """
+    GET in parallelo con requests sui cookie del contesto autenticato
+    (l'APIRequestContext di Playwright sync non si usa fuori dal suo thread).
+    Ritorna {codice: (status, json|None, secondi)}; None se requests manca.
+    """
+    requests = lazy_import("requests")
+    if requests is None:
+        return None
+
+    http = requests.Session()
+    http.headers["User-Agent"] = "Mozilla/5.0 Chrome/120.0.0.0"
+    for c in context.cookies(PORTAL_URL):
+        http.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"])
+
+    def _get(url):
+        t0 = time.perf_counter()
+        resp = http.get(url, timeout=10)
+        data = resp.json() if resp.ok else None
+        return resp.status_code, data, time.perf_counter() - t0
+
+    futures = {code: get_agenda_executor().submit(_get, url) for code, url in urls.items()}
+    out = {}
+    for code, fut in futures.items():
+        try:
+            out[code] = fut.result()
+        except Exception as e:
+            out[code] = (type(e).__name__, None, 0.0)
+    return out
+
+
+def _agenda_get_serial(context, urls):
+    """Come _agenda_get_concurrent, ma con context.request un codice alla volta."""
+    out = {}
+    for code, url in urls.items():
+        t0 = time.perf_counter()
+        try:
+            resp = context.request.get(url, timeout=10000)
+            data = resp.json() if resp.ok else None
+            out[code] = (resp.status, data, time.perf_counter() - t0)
+        except Exception as e:
+            out[code] = (type(e).__name__, None, time.perf_counter() - t0)
+    return out
+
+
+def fetch_agenda_index(context, anno, mesi, debug):
+    """
+    Eventi di tutti i CALENDAR_CODES per i mesi indicati (anno intero o un solo
+    mese), indicizzati mese -> giorno -> [(codice, summary)].
+    Le chiamate per codice partono insieme: la latenza è quella della più lenta.
+    None se nessuna chiamata ha risposto.
+    """
+    start = f"{anno}-{mesi[0]:02d}-01T00:00:00"
+    if mesi[-1] == 12:
+        end = f"{anno}-12-31T00:00:00"
+    else:
+        end = f"{anno}-{mesi[-1] + 1:02d}-01T00:00:00"
+    urls = {
+        code: f"{PORTAL_URL}/api/time/v2/events?$filter_api=calendarCode={code},startTime={start},endTime={end}"
+        for code in CALENDAR_CODES
+    }
+
+    t0 = time.perf_counter()
+    responses = _agenda_get_concurrent(context, urls)
+    if not responses or all(data is None for _, data, _ in responses.values()):
+        # Cookie non sufficienti fuori dal browser: richieste dal contesto Playwright
+        responses = _agenda_get_serial(context, urls)
+    debug.append(f"  ⏱️ {len(urls)} codici in {time.perf_counter() - t0:.2f}s")
+
+    index = {}
+    answered = False
+    for code, name in CALENDAR_CODES.items():
+        status, data, secs = responses[code]
+        debug.append(f"  {code}: status={status} ({secs:.2f}s)")
+        if data is None:
+            continue
+        answered = True
+        try:
+            events = (data if isinstance(data, list) else [data]) if data else []
+            count = 0
+            for ev in events:
+                start_ev = ev.get("startTime", "") or ev.get("start", "")
+                try:
+                    ev_month, ev_day = int(start_ev[5:7]), int(start_ev[8:10])
+                except (ValueError, TypeError):
+                    continue
+                if ev_month not in mesi:
+                    continue
+                day = index.setdefault(ev_month, {}).setdefault(ev_day, [])
+                day.append((code, ev.get("summary", name)))
+                count += 1
+            if count:
+                debug.append(f"  ✅ {code}: {count} eventi")
+        except Exception as e:
+            debug.append(f"  ❌ {code} parse error: {e}")
+
+    return index if answered else None
+
+
+def agenda_from_index(days, debug):
+    """Risultato agenda (formato di read_agenda) da un indice giorno -> eventi."""
+    ledger = AgendaLedger()
+    for giorno, events in days.items():
+        for code, summary in events:
+            key = AGENDA_CODE_KEYS.get(code, CALENDAR_CODES.get(code, code))
+            ledger.add(giorno, key, "api", summary)
+
+    result = ledger.fill({"debug": debug, "success": False})
+    if result["total_events"] > 0:
+        result["success"] = True
+
+    return result
+
+
+def read_agenda_api(context, mese_num, anno, user=None):
+    """
+    Legge l'agenda tramite chiamate API dirette, passando dalla cache annuale.
+    Anno assente o scaduto: si scarica l'anno intero; anno valido ma mese in
+    corso scaduto: si rilegge solo quel mese.
+    """
+    cache = get_agenda_cache()
+    if user:
+        days = cache.month(user, anno, mese_num)
+        if days is not None:
+            return agenda_from_index(days, ["⚡ Agenda dalla cache annuale"])
+
+    mesi = [mese_num] if user and cache.has_year(user, anno) else list(range(1, 13))
+    debug = ["📡 Tentativo API dirette..."]
+    index = fetch_agenda_index(context, anno, mesi, debug)
+    if index is None:
+        return agenda_from_index({}, debug)
+
+    if user:
+        cache.put(user, anno, mesi, index)
+    return agenda_from_index(index.get(mese_num, {}), debug)
+
+
+# ==============================================================================
+# SESSIONE BROWSER PERSISTENTE
+# ==============================================================================
+class LoginFailed(Exception):
+    """Credenziali rifiutate dal portale."""
+
+
+class ResourceFilter:
+    """
+    Profilo di caricamento dei contesti del pool. Con "lean" vengono annullate
+    tutte le richieste verso host esterni al portale e, sul portale, media,
+    tracce e manifest. Immagini e font del portale passano: i flussi cliccano
+    icone (.z-image, .calendar16, glifi dei font ZK) che senza di essi non
+    sarebbero visibili. I byte risparmiati sono stimati: dimensione già vista
+    per lo stesso URL, altrimenti media osservata (o di default) per tipo.
+    """
+
+    BLOCKED_TYPES = {"media", "texttrack", "manifest"}
+    DEFAULT_SIZES = {"image": 15_000, "font": 40_000, "media": 200_000}
+
+    def __init__(self, profile="lean"):
+        self.profile = profile
+        host = urlparse(PORTAL_URL).hostname or ""
+        self._domain = ".".join(host.split(".")[-2:])
+        self._lock = threading.Lock()
+        self._sizes = {}  # url -> byte (content-length)
+        self._type_sizes = {}  # tipo -> (byte totali, risposte)
+
+    def install(self, ctx):
+        """Attiva il profilo sul contesto; ritorna i contatori del contesto."""
+        counter = {"richieste": 0, "byte": 0}
+        ctx.on("response", self._learn)
+        if self.profile != "full":
+            ctx.route("**/*", lambda route: self._route(route, counter))
+        return counter
+
+    def _third_party(self, url):
+        host = urlparse(url).hostname or ""
+        return bool(host) and not (
+            host == self._domain or host.endswith("." + self._domain)
+        )
+
+    def _route(self, route, counter):
+        req = route.request
+        url = req.url
+        if self._third_party(url) or req.resource_type in self.BLOCKED_TYPES:
+            counter["richieste"] += 1
+            counter["byte"] += self._estimate(url, req.resource_type)
+            try:
+                route.abort()
+            except:
+                pass
+            return
+        try:
+            route.continue_()
+        except:
+            pass
+
+    def _learn(self, response):
+        try:
+            size = int(response.headers.get("content-length", 0))
+            kind = response.request.resource_type
+        except Exception:
+            return
+        if size <= 0:
+            return
+        with self._lock:
+            if len(self._sizes) < 5000:
+                self._sizes[response.url] = size
+            tot, n = self._type_sizes.get(kind, (0, 0))
+            self._type_sizes[kind] = (tot + size, n + 1)
+
+    def _estimate(self, url, kind):
+        with self._lock:
+            if url in self._sizes:
+                return self._sizes[url]
+            tot, n = self._type_sizes.get(kind, (0, 0))
+        if n:
+            return tot // n
+        return self.DEFAULT_SIZES.get(kind, 10_000)
+
+
+class BrowserSessionPool:
+    """
+    Chromium sempre acceso con un contesto autenticato per utente.
+    I cookie vengono salvati su disco (storage_state) e il login completo
+    viene rifatto solo quando il portale mostra di nuovo la maschera di accesso.
+
+    Playwright sync è legato al thread che lo avvia, quindi il pool ha più
+    "corsie": ognuna è un thread con il proprio Chromium. Le corsie condividono
+    i cookie della stessa sessione, così i rami di un'analisi (agenda, busta,
+    cartellino) girano in parallelo con un solo login. Una corsia senza
+    sessioni attive chiude il proprio Chromium finché non arriva un nuovo job.
+    """
+
+    def __init__(self, lanes=1):
+        self._lanes = [
+            {
+                "executor": ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f"browser-{i}"
+                ),
+                "playwright": None,
+                "browser": None,
+                "sessions": {},  # user -> {"ctx", "pwd_hash", "version", "last_used"}
+            }
+            for i in range(max(1, lanes))
+        ]
+        self._lock = threading.Lock()
+        self._filter = ResourceFilter(RESOURCE_PROFILE)
+        self._shared = {}  # user -> {"state", "version"} cookie comuni alle corsie
+        self._login_locks = {}  # user -> Lock: un solo login alla volta
+        self._failed = {}  # user -> {"pwd_hash", "at"}: ultimo login rifiutato
+        threading.Thread(target=self._sweep, name="browser-sweep", daemon=True).start()
+
+    @property
+    def lanes(self):
+        return len(self._lanes)
+
+    def submit(self, user, pwd, job, waiter=None, relay=None, lane=0):
+        """
+        Accoda job(ctx, page) sulla corsia indicata e ritorna un Future.
+        Il Future solleva LoginFailed se il portale rifiuta le credenziali.
+        """
+        script_ctx = get_script_run_ctx()
+        waiter = waiter or StepWaiter()
+        lane_state = self._lanes[lane % len(self._lanes)]
+        submitted = time.time()
+
+        def _task():
+            # Permette chiamate st.* dai rami che non usano il relay
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+            return self._run_job(lane_state, user, pwd, job, waiter, relay, submitted)
+
+        return lane_state["executor"].submit(_task)
+
+    def run(self, user, pwd, job, waiter=None, relay=None, lane=0):
+        """Come submit, ma attende il risultato."""
+        return self.submit(user, pwd, job, waiter, relay, lane).result()
+
+    def _login_refused(self, user, pwd, submitted):
+        """
+        True se le stesse credenziali sono state rifiutate dopo l'accodamento
+        del job: i rami dello stesso click non ritentano il login (rischio di
+        blocco account), un nuovo click invece riprova una volta.
+        """
+        pwd_hash = hashlib.sha256(f"{user}:{pwd}".encode()).hexdigest()
+        with self._lock:
+            failed = self._failed.get(user)
+        return bool(
+            failed and failed["pwd_hash"] == pwd_hash and failed["at"] >= submitted
+        )
+
+    def _run_job(self, lane, user, pwd, job, waiter, relay, submitted):
+        self._evict_idle(lane)
+        if self._login_refused(user, pwd, submitted):
+            raise LoginFailed(user)
+        ctx = self._get_context(lane, user, pwd)
+        blocked = lane["sessions"][user]["blocked"]
+        before = dict(blocked)
+        page = ctx.new_page()
+        try:
+            if not self._ensure_logged_in(
+                lane, page, user, pwd, waiter, relay, submitted
+            ):
+                self._drop(lane, user)
+                raise LoginFailed(user)
+            return job(ctx, page)
+        finally:
+            try:
+                page.close()
+            except:
+                pass
+            if user in lane["sessions"]:
+                lane["sessions"][user]["last_used"] = time.time()
+                self._save_state(lane, user)
+            waiter.add_blocked({k: blocked[k] - before[k] for k in blocked})
+
+    def _ensure_browser(self, lane):
+        if lane["browser"] and lane["browser"].is_connected():
+            return
+        # Browser morto: i contesti associati non sono più utilizzabili
+        lane["sessions"].clear()
+        if lane["playwright"] is None:
+            sync_playwright = lazy_import("playwright.sync_api", "sync_playwright")
+            lane["playwright"] = sync_playwright().start()
+        try:
+            lane["browser"] = lane["playwright"].chromium.launch(
+                headless=True, args=["--no-sandbox", "--disable-gpu"]
             )
-            result["items"].append(f"💤 RIPOSO: {summary[:50]}")
+        except Exception as e:
+            if "Executable doesn't exist" not in str(e):
+                raise
+            # Marker presente ma browser rimosso (es. cache svuotata): reinstalla
+            install_chromium()
+            lane["browser"] = lane["playwright"].chromium.launch(
+                headless=True, args=["--no-sandbox", "--disable-gpu"]
+            )
+
+    def _state_file(self, user):
+        return SESSION_DIR / f"{hashlib.sha256(user.encode()).hexdigest()[:16]}.json"
+
+    def _get_context(self, lane, user, pwd):
+        self._ensure_browser(lane)
+        pwd_hash = hashlib.sha256(f"{user}:{pwd}".encode()).hexdigest()
+
+        sess = lane["sessions"].get(user)
+        if sess and sess["pwd_hash"] != pwd_hash:
+            self._drop(lane, user)
+            sess = None
+
+        with self._lock:
+            shared = self._shared.get(user)
+
+        if sess is None:
+            # Cookie dalla corsia che ha fatto login, altrimenti dal disco
+            state_file = self._state_file(user)
+            if shared:
+                storage_state = shared["state"]
+            elif state_file.exists():
+                storage_state = str(state_file)
+            else:
+                storage_state = None
+            ctx = lane["browser"].new_context(
+                accept_downloads=True,
+                user_agent="Mozilla/5.0 Chrome/120.0.0.0",
+                viewport={"width": 1920, "height": 1080},
+                storage_state=storage_state,
+            )
+            ctx.set_default_timeout(45000)
+            sess = {
+                "ctx": ctx,
+                "pwd_hash": pwd_hash,
+                "version": shared["version"] if shared else 0,
+                "last_used": time.time(),
+                "blocked": self._filter.install(ctx),
+            }
+            lane["sessions"][user] = sess
+        elif shared and shared["version"] > sess["version"]:
+            # Un'altra corsia ha rifatto il login: aggiorna i cookie
+            self._adopt_shared(sess, shared)
+
+        return sess["ctx"]
+
+    def _adopt_shared(self, sess, shared):
+        try:
+            sess["ctx"].add_cookies(shared["state"].get("cookies", []))
+            sess["version"] = shared["version"]
+        except:
+            pass
+
+    def _is_logged_in(self, page, waiter):
+        home = page.locator("text=I miei dati")
+        try:
+            page.goto(PORTAL_URL, wait_until="domcontentloaded")
+            with waiter.timed("sessione: verifica cookie", "selettore"):
+                home.or_(page.locator('input[type="password"]')).first.wait_for(
+                    timeout=WAIT_BUDGETS["login"]
+                )
+            return home.first.is_visible()
+        except:
+            return False
+
+    def _ensure_logged_in(self, lane, page, user, pwd, waiter, relay, submitted):
+        """Riusa la sessione se ancora valida, altrimenti login completo."""
+        if self._is_logged_in(page, waiter):
+            return True
+
+        with self._lock:
+            login_lock = self._login_locks.setdefault(user, threading.Lock())
+
+        with login_lock:
+            # Nel frattempo un'altra corsia potrebbe aver già rifatto il login
+            sess = lane["sessions"][user]
+            with self._lock:
+                shared = self._shared.get(user)
+            if shared and shared["version"] > sess["version"]:
+                self._adopt_shared(sess, shared)
+                if self._is_logged_in(page, waiter):
+                    return True
+            if self._login_refused(user, pwd, submitted):
+                # Un'altra corsia ha appena provato queste credenziali
+                return False
+
+            # === LOGIN ===
+            (relay or st).toast("🔐 Login...", icon="🔐")
+            page.goto(f"{PORTAL_URL}?r=y", wait_until="domcontentloaded")
+            page.wait_for_selector('input[type="text"]', timeout=10000)
+            page.fill('input[type="text"]', user)
+            page.fill('input[type="password"]', pwd)
+            page.press('input[type="password"]', "Enter")
+
+            if not waiter.selector(page, "text=I miei dati", "login", "login"):
+                with self._lock:
+                    self._failed[user] = {
+                        "pwd_hash": sess["pwd_hash"],
+                        "at": time.time(),
+                    }
+                return False
+
+            with self._lock:
+                self._failed.pop(user, None)
+            self._save_state(lane, user, new_login=True)
+            return True
+
+    def _save_state(self, lane, user, new_login=False):
+        sess = lane["sessions"].get(user)
+        if not sess:
+            return
+        try:
+            state = sess["ctx"].storage_state()
+            with self._lock:
+                shared = self._shared.get(user)
+                version = shared["version"] if shared else 0
+                if new_login:
+                    version += 1
+                    sess["version"] = version
+                elif sess["version"] < version:
+                    # Cookie più vecchi dell'ultimo login di un'altra corsia
+                    return
+                self._shared[user] = {"state": state, "version": version}
+
+            SESSION_DIR.mkdir(exist_ok=True)
+            state_file = self._state_file(user)
+            state_file.write_text(json.dumps(state))
+            os.chmod(state_file, 0o600)
+        except:
+            pass
+
+    def _drop(self, lane, user):
+        sess = lane["sessions"].pop(user, None)
+        if sess:
+            try:
+                sess["ctx"].close()
+            except:
+                pass
+
+    def _evict_idle(self, lane):
+        now = time.time()
+        idle = [
+            u
+            for u, s in lane["sessions"].items()
+            if now - s["last_used"] > SESSION_IDLE_TTL
+        ]
+        for user in idle:
+            self._drop(lane, user)
+
+    def _release_idle(self, lane):
+        """Sul thread della corsia: chiude sessioni scadute e, se non ne restano, Chromium."""
+        self._evict_idle(lane)
+        if lane["sessions"] or lane["playwright"] is None:
+            return
+        try:
+            if lane["browser"]:
+                lane["browser"].close()
+            lane["playwright"].stop()
+        except:
+            pass
+        lane["browser"] = lane["playwright"] = None
+
+    def _sweep(self):
+        # Anche senza nuovi job le corsie inattive liberano la memoria del browser
+        while True:
+            time.sleep(SESSION_IDLE_TTL / 4)
+            for lane in self._lanes:
+                if lane["playwright"] is not None:
+                    lane["executor"].submit(self._release_idle, lane)
+
+
+@st.cache_resource
+def get_browser_pool():
+    """Un solo pool per processo, condiviso fra sessioni e rerun di Streamlit."""
+    return BrowserSessionPool(lanes=BROWSER_LANES)
+
+
+# ==============================================================================
+# SCRAPER CORE
+# ==============================================================================
+def read_agenda(ctx, page, idx, anno, waiter, relay, user=None):
+    """
+    Ramo agenda: navigazione al calendario, fallback su API dirette.
+    Le API scaldano comunque la cache annuale (niente chiamate per gli altri
+    mesi dello stesso anno); il risultato finale viene salvato per mese e,
+    se ancora valido quando il job parte, restituito senza navigazione.
+    """
+    cache = get_agenda_cache()
+    cached = cache.result(user, anno, idx) if user else None
+    if cached is not None:
+        relay.toast("⚡ Agenda dalla cache", icon="📅")
+        return cached
+
+    relay.toast("🗓️ Lettura Agenda...", icon="🗓️")
+    try:
+        # Prima prova con navigazione al calendario
+        agenda = read_agenda_with_navigation(page, ctx, idx, anno, waiter)
+        api = read_agenda_api(ctx, idx, anno, user)
+        if agenda["total_events"] == 0:
+            # Fallback: API dirette
+            agenda = api
+
+        if agenda["total_events"] > 0:
+            relay.toast(f"✅ Agenda: {agenda['total_events']} eventi", icon="📅")
+            # Un mese vuoto può essere una lettura fallita: non si memorizza
+            if user:
+                cache.put_result(user, anno, idx, agenda)
+        return agenda
+    except Exception as e:
+        return {
+            "events_by_type": {},
+            "total_events": 0,
+            "debug": [str(e)],
+        }
+
+
+# Tutti i link della pagina in un solo evaluate; ognuno viene marcato con
+# data-gp-doc per poterlo cliccare senza ripetere la scansione
+DOCUMENT_LINKS_JS = """
+() => [...document.querySelectorAll('a')].map((a, i) => {
+    a.setAttribute('data-gp-doc', String(i));
+    return {i, text: (a.innerText || '').trim(), href: a.href || ''};
+})
+"""
+
+
+@st.cache_resource
+def get_document_catalogs():
+    """Utente (hash) -> {"built": ts, "docs": {(anno, mese): link}}; mese 13 = tredicesima."""
+    return {}
+
+
+def _document_period(text):
+    """(anno, mese) del documento dal testo del link, None se non riconosciuto."""
+    low = text.lower()
+    year = re.search(r"\b(20\d{2})\b", low)
+    if not year:
+        return None
+    if "tredicesima" in low or re.search(r"\b13\s*(ma|°|a)\b", low):
+        return int(year.group(1)), 13
+    for i, nome in enumerate(MESI_IT):
+        if nome.lower() in low:
+            return int(year.group(1)), i + 1
+    m = re.search(r"\b(\d{2})[/-](20\d{2})\b", low)
+    if m and 1 <= int(m.group(1)) <= 12:
+        return int(m.group(2)), int(m.group(1))
+    return None
+
+
+def build_document_catalog(page, user=None):
+    """
+    Indice (anno, mese) -> link dei documenti visibili, in un solo round trip.
+    Vince il primo link in ordine di pagina, come nella vecchia scansione.
+    """
+    docs = {}
+    for link in page.evaluate(DOCUMENT_LINKS_JS):
+        if len(link["text"]) < 4:
+            continue
+        period = _document_period(link["text"])
+        if period and period not in docs:
+            docs[period] = link
+    if user:
+        get_document_catalogs()[hashlib.sha256(user.encode()).hexdigest()[:16]] = {
+            "built": time.time(),
+            "docs": docs,
+        }
+    return docs
+
+
+def cached_document(user, anno, mese):
+    """Link dal catalogo della sessione, se ancora valido."""
+    catalog = get_document_catalogs().get(hashlib.sha256(user.encode()).hexdigest()[:16])
+    if not catalog or time.time() - catalog["built"] > DOC_CATALOG_TTL:
+        return None
+    return catalog["docs"].get((anno, mese))
+
+
+def download_busta(page, mese_nome, idx, anno, is_13ma, waiter, relay, user=None):
+    """
+    Ramo busta: I miei dati -> Documenti -> Cedolino -> download del mese.
+    Il link si sceglie dal catalogo documenti; se il catalogo della sessione
+    ha già un URL scaricabile per il mese, basta una GET senza navigazione.
+    """
+    relay.toast("💰 Scarico Busta...", icon="💰")
+    mese_doc = 13 if is_13ma else idx
+    name = f"busta_{mese_doc}_{anno}.pdf"
+    cached = cached_document(user, anno, mese_doc) if user else None
+    if cached and cached["href"].startswith("http"):
+        try:
+            with waiter.timed("busta: GET diretta da catalogo", "rete"):
+                body = page.context.request.get(cached["href"], timeout=60000).body()
+            if body[:4] == b"%PDF":
+                relay.toast(f"✅ Busta: {len(body):,} bytes", icon="📄")
+                return PdfDocument(body, name)
+        except Exception:
+            pass
+
+    try:
+        open_documenti(page, waiter)
+
+        # 4) Cerca e clicca link
+        with waiter.timed("busta: download"), page.expect_download(
+            timeout=WAIT_BUDGETS["download"]
+        ) as dl_info:
+            link = build_document_catalog(page, user).get((anno, mese_doc))
+            if link:
+                page.locator(f"a[data-gp-doc='{link['i']}']").first.click()
+            elif is_13ma:
+                page.get_by_text(re.compile(f"Tredicesima.*{anno}", re.I)).first.click()
+            else:
+                raise Exception("Link busta non trovato")
 
-    result["total_events"] = sum(result["events_by_type"].values())
-    result["debug"].append(f"📊 Totale categorizzati: {result['total_events']}")
-    result["success"] = True  # Flag Esplicito di Successo
+        # Byte letti dal file temporaneo di Playwright, poi eliminato subito:
+        # il cedolino in chiaro non resta su disco fino alla chiusura del contesto
+        data = Path(dl_info.value.path()).read_bytes()
+        dl_info.value.delete()
+        if len(data) > 1000:
+            relay.toast(f"✅ Busta: {len(data):,} bytes", icon="📄")
+            return PdfDocument(data, name)
 
-    return result
+    except Exception as e:
+        relay.warning(f"⚠️ Busta: {e}")
+    return None
 
 
-def read_agenda_api(context, mese_num, anno):
-    """Fallback: Legge l'agenda tramite chiamate API dirette."""
-    result = {
-        "events_by_type": {},
-        "total_events": 0,
-        "items": [],
-        "debug": ["📡 Tentativo API dirette..."],
-        "success": False,
-    }
+def open_documenti(page, waiter):
+    """I miei dati -> Documenti -> elenco Cedolino espanso."""
+    # 1) Clicca "I miei dati"
+    try:
+        page.evaluate(
+            "document.getElementById('revit_navigation_NavHoverItem_0_label')?.click()"
+        )
+    except:
+        page.locator("text=I miei dati").first.click(force=True)
 
-    base_url = "https://selfservice.gottardospa.it/js_rev/JSipert2"
-    
-    # Mappa codici API -> chiavi normalizzate (coerenti con il resto del codice)
-    CODE_TO_NORMALIZED = {
-        "FEP": "FERIE",
-        "OMT": "OMESSA TIMBRATURA",
-        "RCS": "RIPOSO",
-        "RIC": "RIPOSO",
-        "MAL": "MALATTIA",
-    }
+    # 2) Tab "Documenti"
+    waiter.selector(page, "span[id^='lnktab_']", "busta: tab I miei dati")
 
-    for code, name in CALENDAR_CODES.items():
+    for js_id in ["lnktab_2_label", "lnktab_2"]:
         try:
-            url = f"{base_url}/api/time/v2/events?$filter_api=calendarCode={code},startTime={anno}-01-01T00:00:00,endTime={anno}-12-31T00:00:00"
-            resp = context.request.get(url, timeout=10000)
+            page.evaluate(f"document.getElementById('{js_id}')?.click()")
+            break
+        except:
+            continue
 
-            result["debug"].append(f"  {code}: status={resp.status}")
+    try:
+        page.locator(
+            "span", has_text=re.compile(r"\bDocumenti\b", re.I)
+        ).first.click(force=True)
+    except:
+        pass
 
-            if resp.ok:
-                try:
-                    data = resp.json()
-                    if data:
-                        events = data if isinstance(data, list) else [data]
-
-                        month_events = []
-                        for ev in events:
-                            start = ev.get("startTime", "") or ev.get("start", "")
-                            if start and len(start) >= 7:
-                                try:
-                                    ev_month = int(start[5:7])
-                                    if ev_month == mese_num:
-                                        month_events.append(ev)
-                                        result["items"].append(
-                                            f"{code}: {ev.get('summary', name)}"
-                                        )
-                                except:
-                                    pass
-
-                        if month_events:
-                            # Usa chiave normalizzata
-                            normalized_key = CODE_TO_NORMALIZED.get(code, name)
-                            result["events_by_type"][normalized_key] = (
-                                result["events_by_type"].get(normalized_key, 0) + len(month_events)
-                            )
-                            result["total_events"] += len(month_events)
-                            result["debug"].append(
-                                f"  ✅ {code}: {len(month_events)} eventi"
-                            )
-                except Exception as e:
-                    result["debug"].append(f"  ❌ {code} parse error: {e}")
+    # 3) Espandi "Cedolino"
+    waiter.selector(page, "text=Cedolino", "busta: tab Documenti")
+
+    try:
+        page.locator("tr", has=page.locator("text=Cedolino")).locator(
+            ".z-image"
+        ).click(timeout=5000)
+    except:
+        page.locator("text=Cedolino").first.click(force=True)
+    waiter.dom_stable(page, "busta: elenco cedolini", "page")
+
+
+def sync_documenti(page, user, pwd, waiter, relay):
+    """
+    Sincronizzazione archivio: un solo giro nel tab Documenti, poi scarica
+    soltanto i cedolini nuovi o con link cambiato rispetto all'archivio.
+    """
+    archive = get_document_archive(user, pwd)
+    if archive is None:
+        return {"scaricati": 0, "aggiornati": 0}
+
+    open_documenti(page, waiter)
+    docs = build_document_catalog(page, user)
+    stats = {"scaricati": 0, "aggiornati": 0}
+    for (anno, mese), link in sorted(docs.items()):
+        if archive.fresh("busta", anno, mese, link):
+            stats["aggiornati"] += 1
+            continue
+        try:
+            with waiter.timed(f"sync: busta {mese:02d}/{anno}"), page.expect_download(
+                timeout=WAIT_BUDGETS["download"]
+            ) as dl_info:
+                page.locator(f"a[data-gp-doc='{link['i']}']").first.click()
+            data = Path(dl_info.value.path()).read_bytes()
+            dl_info.value.delete()
+            archive.store("busta", anno, mese, data, link)
+            stats["scaricati"] += 1
+            relay.toast(f"🗄️ Archiviata busta {mese:02d}/{anno}", icon="🗄️")
         except Exception as e:
-            result["debug"].append(f"  ⚠️ {code}: {type(e).__name__}")
+            relay.warning(f"⚠️ Sync busta {mese:02d}/{anno}: {e}")
+    return stats
 
-    if result["total_events"] > 0:
-        result["success"] = True
-    
-    return result
 
+JPSC_RE = re.compile(r"SERVIZIO=JPSC", re.I)  # Servizio stampa PDF del cartellino
+
+
+@st.cache_resource
+def get_cartellino_templates():
+    """Utente (hash) -> URL JPSC con le date del periodo come segnaposto."""
+    return {}
+
+
+def _cartellino_dates(idx, anno):
+    """Date del periodo nei formati che possono comparire nell'URL JPSC."""
+    last_day = calendar.monthrange(anno, idx)[1]
+    out = {}
+    for name, day in (("{dal}", 1), ("{al}", last_day)):
+        out[name] = [
+            f"{day:02d}/{idx:02d}/{anno}",
+            quote(f"{day:02d}/{idx:02d}/{anno}", safe=""),
+            f"{anno}{idx:02d}{day:02d}",
+            f"{anno}-{idx:02d}-{day:02d}",
+        ]
+    return out
+
+
+def learn_cartellino_template(user, url, idx, anno):
+    """Memorizza l'URL JPSC come modello se contiene le date del periodo."""
+    template = url
+    for name, variants in _cartellino_dates(idx, anno).items():
+        for v in variants:
+            template = template.replace(v, f"{name}|{variants.index(v)}")
+    if "{dal}" in template and "{al}" in template:
+        get_cartellino_templates()[hashlib.sha256(user.encode()).hexdigest()[:16]] = template
+
+
+def cartellino_url_from_template(user, idx, anno):
+    """URL JPSC del mese dal modello appreso, None se non ancora disponibile."""
+    template = get_cartellino_templates().get(hashlib.sha256(user.encode()).hexdigest()[:16])
+    if not template:
+        return None
+    for name, variants in _cartellino_dates(idx, anno).items():
+        for i, v in enumerate(variants):
+            template = template.replace(f"{name}|{i}", v)
+    return template
 
-# ==============================================================================
-# SCRAPER CORE
-# ==============================================================================
-def execute_download(mese_nome, anno, user, pwd, is_13ma):
-    """Scarica busta paga, cartellino e legge agenda."""
-    results = {"busta": None, "cart": None, "agenda": None}
 
+def fetch_cartellino_pdf(ctx, url, relay):
+    """GET diretto dell'URL JPSC; byte del PDF o None."""
+    url = url.replace("/js_rev//", "/js_rev/")
+    if "EMBED" not in url:
+        url += "&EMBED=y"
     try:
-        idx = MESI_IT.index(mese_nome) + 1
-    except:
-        return results
+        body = ctx.request.get(url, timeout=60000).body()
+    except Exception:
+        return None
+    if body[:4] != b"%PDF":
+        return None
+    relay.toast(f"✅ Cartellino: {len(body):,} bytes", icon="📋")
+    return body
+
+
+def download_cartellino(ctx, page, idx, anno, waiter, relay, user=None):
+    """
+    Ramo cartellino: Time -> Cartellino -> ricerca per date -> PDF.
+    Se un mese precedente ha già rivelato il modello dell'URL JPSC, il PDF
+    arriva con una sola GET, senza navigazione; altrimenti la richiesta JPSC
+    viene intercettata al click (popup bloccato) e scaricata direttamente.
+    """
+    relay.toast("📅 Scarico Cartellino...", icon="📅")
+    name = f"cartellino_{idx}_{anno}.pdf"
+    direct_url = cartellino_url_from_template(user, idx, anno) if user else None
+    if direct_url:
+        with waiter.timed("cartellino: GET diretta da modello", "rete"):
+            data = fetch_cartellino_pdf(ctx, direct_url, relay)
+        if data:
+            return PdfDocument(data, name)
 
-    suffix = "_13" if is_13ma else ""
-    local_busta = os.path.abspath(f"busta_{idx}_{anno}{suffix}.pdf")
-    local_cart = os.path.abspath(f"cartellino_{idx}_{anno}.pdf")
-    target_busta = f"Tredicesima {anno}" if is_13ma else f"{mese_nome} {anno}"
+    try:
+        # Time menu
+        try:
+            page.evaluate(
+                "document.getElementById('revit_navigation_NavHoverItem_2_label')?.click()"
+            )
+        except:
+            page.locator("text=Time").first.click(force=True)
+        waiter.selector(
+            page,
+            "#lnktab_5_label",
+            "cartellino: menu Time",
+            "menu",
+            state="attached",
+        )
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True, args=["--no-sandbox", "--disable-gpu"]
+        # Tab Cartellino presenze
+        try:
+            page.evaluate("document.getElementById('lnktab_5_label')?.click()")
+        except:
+            page.locator("text=Cartellino").first.click(force=True)
+        waiter.selector(
+            page,
+            "input[id*='CLRICHIE'][class*='dijitInputInner']",
+            "cartellino: tab Cartellino",
         )
-        ctx = browser.new_context(
-            accept_downloads=True, user_agent="Mozilla/5.0 Chrome/120.0.0.0"
+
+        # Date
+        last_day = calendar.monthrange(anno, idx)[1]
+        d1, d2 = f"01/{idx:02d}/{anno}", f"{last_day}/{idx:02d}/{anno}"
+
+        dal = page.locator("input[id*='CLRICHIE'][class*='dijitInputInner']").first
+        al = page.locator("input[id*='CLRICHI2'][class*='dijitInputInner']").first
+
+        if dal.count() > 0 and al.count() > 0:
+            dal.click(force=True)
+            page.keyboard.press("Control+A")
+            dal.fill("")
+            dal.type(d1, delay=80)
+            dal.press("Tab")
+            waiter.dom_stable(page, "cartellino: data dal", "input", 150)
+
+            al.click(force=True)
+            page.keyboard.press("Control+A")
+            al.fill("")
+            al.type(d2, delay=80)
+            al.press("Tab")
+            waiter.dom_stable(page, "cartellino: data al", "input", 150)
+
+        # Ricerca
+        try:
+            page.locator(
+                "//span[contains(text(),'Esegui ricerca')]/ancestor::span[@role='button']"
+            ).last.click(force=True)
+        except:
+            page.get_by_role(
+                "button", name=re.compile("ricerca|esegui", re.I)
+            ).last.click()
+
+        # Icona PDF: si prosegue appena compare la riga del mese
+        pattern_cart = f"{idx:02d}/{anno}"
+        waiter.selector(
+            page,
+            f"tr:has-text('{pattern_cart}') img[src*='search']",
+            "cartellino: risultati ricerca",
+            "search",
         )
-        ctx.set_default_timeout(45000)
-        page = ctx.new_page()
-        page.set_viewport_size({"width": 1920, "height": 1080})
+        riga = page.locator(f"tr:has-text('{pattern_cart}')").first
+        if riga.count() > 0 and riga.locator("img[src*='search']").count() > 0:
+            icona = riga.locator("img[src*='search']").first
+        else:
+            icona = page.locator("img[src*='search']").first
+
+        if icona.count() == 0:
+            return None
 
+        # Richiesta JPSC catturata dalla rete e annullata: il popup non carica il PDF
+        jpsc_url = None
+        ctx.route(JPSC_RE, lambda route: route.abort())
         try:
-            # === LOGIN ===
-            st.toast("🔐 Login...", icon="🔐")
-            page.goto(
-                "https://selfservice.gottardospa.it/js_rev/JSipert2?r=y",
-                wait_until="domcontentloaded",
-            )
-            page.wait_for_selector('input[type="text"]', timeout=10000)
-            page.fill('input[type="text"]', user)
-            page.fill('input[type="password"]', pwd)
-            page.press('input[type="password"]', "Enter")
-            time.sleep(3)
+            with waiter.timed("cartellino: richiesta JPSC", "rete"), ctx.expect_event(
+                "request",
+                predicate=lambda r: bool(JPSC_RE.search(r.url)),
+                timeout=WAIT_BUDGETS["popup"],
+            ) as req_info:
+                icona.click()
+            jpsc_url = req_info.value.url
+        except Exception:
+            pass
+        finally:
+            ctx.unroute(JPSC_RE)
+            for p in ctx.pages:
+                if p != page:
+                    try:
+                        p.close()
+                    except:
+                        pass
+
+        data = fetch_cartellino_pdf(ctx, jpsc_url, relay) if jpsc_url else None
+        if data:
+            if user:
+                learn_cartellino_template(user, jpsc_url, idx, anno)
+            return PdfDocument(data, name)
+
+        # Fallback: popup completo, attesa dell'URL e stampa della pagina
+        with ctx.expect_page(timeout=20000) as popup_info:
+            icona.click()
+        popup = popup_info.value
+
+        try:
+            # Attendi URL PDF
+            waiter.url(popup, r"SERVIZIO=JPSC", "cartellino: URL PDF")
+
+            # Download PDF
+            data = fetch_cartellino_pdf(ctx, popup.url, relay)
+            if data:
+                if user:
+                    learn_cartellino_template(user, popup.url, idx, anno)
+                return PdfDocument(data, name)
 
             try:
-                page.wait_for_selector("text=I miei dati", timeout=15000)
+                data = popup.pdf(format="A4")
+                if len(data) > 5000:
+                    return PdfDocument(data, name)
             except:
-                st.error("❌ Login fallito")
-                browser.close()
-                return results
-
-            # === AGENDA CON NAVIGAZIONE ===
-            st.toast("🗓️ Lettura Agenda...", icon="🗓️")
+                pass
+        finally:
             try:
-                # Prima prova con navigazione al calendario
-                results["agenda"] = read_agenda_with_navigation(page, ctx, idx, anno)
-                if results["agenda"]["total_events"] == 0:
-                    # Fallback: API dirette
-                    results["agenda"] = read_agenda_api(ctx, idx, anno)
-
-                if results["agenda"]["total_events"] > 0:
-                    st.toast(
-                        f"✅ Agenda: {results['agenda']['total_events']} eventi",
-                        icon="📅",
-                    )
-            except Exception as e:
-                results["agenda"] = {
-                    "events_by_type": {},
-                    "total_events": 0,
-                    "debug": [str(e)],
-                }
+                popup.close()
+            except:
+                pass
 
-            # === BUSTA PAGA ===
-            st.toast("💰 Scarico Busta...", icon="💰")
-            try:
-                # 1) Clicca "I miei dati"
-                try:
-                    page.keyboard.press("Escape")
-                    time.sleep(0.3)
-                except:
-                    pass
+    except Exception as e:
+        relay.warning(f"⚠️ Cartellino: {e}")
+    return None
 
-                try:
-                    page.evaluate(
-                        "document.getElementById('revit_navigation_NavHoverItem_0_label')?.click()"
-                    )
-                except:
-                    page.locator("text=I miei dati").first.click(force=True)
-                time.sleep(2)
 
-                # 2) Tab "Documenti"
-                try:
-                    page.wait_for_selector("span[id^='lnktab_']", timeout=10000)
-                except:
-                    pass
+def submit_download(mese_nome, anno, user, pwd, is_13ma, relay):
+    """
+    Accoda sulle corsie del pool i rami di un mese (busta, agenda, cartellino).
+    Ritorna (futures per ramo, timings, risorse bloccate): ogni corsia esegue i job in ordine,
+    quindi più mesi accodati insieme procedono a catena con la stessa sessione.
+    """
+    idx = MESI_IT.index(mese_nome) + 1
+    waiter = StepWaiter()
+    mese_doc = 13 if is_13ma else idx
+    archive = get_document_archive(user, pwd)
+
+    def _archived(kind, mese, doc_fn):
+        # Dopo il download il PDF finisce anche nell'archivio cifrato
+        def _job(ctx, page):
+            doc = doc_fn(ctx, page)
+            if doc and archive:
+                link = cached_document(user, anno, mese) if kind == "busta" else None
+                if archive.store(kind, anno, mese, doc.data, link):
+                    relay.toast(f"🔁 {doc.name}: nuova versione sul portale", icon="🗄️")
+            return doc
+
+        return _job
+
+    branches = {
+        "busta": _archived(
+            "busta",
+            mese_doc,
+            lambda ctx, page: download_busta(
+                page, mese_nome, idx, anno, is_13ma, waiter, relay, user
+            ),
+        ),
+        "agenda": lambda ctx, page: read_agenda(
+            ctx, page, idx, anno, waiter, relay, user
+        ),
+    }
+    if not is_13ma:
+        branches["cart"] = _archived(
+            "cart",
+            idx,
+            lambda ctx, page: download_cartellino(
+                ctx, page, idx, anno, waiter, relay, user
+            ),
+        )
 
-                for js_id in ["lnktab_2_label", "lnktab_2"]:
-                    try:
-                        page.evaluate(f"document.getElementById('{js_id}')?.click()")
-                        break
-                    except:
-                        continue
+    # Rami già soddisfatti senza portale: cache agenda e archivio documenti
+    ready = {}
+    cached_agenda = get_agenda_cache().result(user, anno, idx)
+    if cached_agenda is not None:
+        ready["agenda"] = cached_agenda
+        relay.toast("⚡ Agenda dalla cache", icon="📅")
+    if archive:
+        link = cached_document(user, anno, mese_doc)
+        data = archive.restore("busta", anno, mese_doc, link)
+        if data:
+            ready["busta"] = PdfDocument(data, f"busta_{mese_doc}_{anno}.pdf")
+        data = archive.restore("cart", anno, idx) if "cart" in branches else None
+        if data:
+            ready["cart"] = PdfDocument(data, f"cartellino_{idx}_{anno}.pdf")
+        if ready.keys() & {"busta", "cart"}:
+            relay.toast("🗄️ Documenti dall'archivio locale", icon="🗄️")
+
+    # Sessione dal pool: login solo se i cookie salvati sono scaduti
+    pool = get_browser_pool()
+    futures = {
+        key: pool.submit(user, pwd, job, waiter, relay, lane=BRANCH_LANES[key])
+        for key, job in branches.items()
+        if key not in ready
+    }
+    for key, value in ready.items():
+        futures[key] = Future()
+        futures[key].set_result(value)
+    return futures, waiter.timings, waiter.blocked
 
-                try:
-                    page.locator(
-                        "span", has_text=re.compile(r"\bDocumenti\b", re.I)
-                    ).first.click(force=True)
-                except:
-                    pass
-                time.sleep(2)
 
-                # 3) Espandi "Cedolino"
-                try:
-                    page.wait_for_selector("text=Cedolino", timeout=10000)
-                except:
-                    pass
+def collect_download(futures):
+    """Risultati dei rami completati; solleva LoginFailed se il login è fallito."""
+    results = {"busta": None, "cart": None, "agenda": None}
+    login_failed = False
+    for key, fut in futures.items():
+        try:
+            results[key] = fut.result()
+        except LoginFailed:
+            login_failed = True
+        except Exception as e:
+            st.error(f"❌ Errore ({key}): {e}")
+    if login_failed:
+        raise LoginFailed()
+    return results
 
-                try:
-                    page.locator("tr", has=page.locator("text=Cedolino")).locator(
-                        ".z-image"
-                    ).click(timeout=5000)
-                except:
-                    page.locator("text=Cedolino").first.click(force=True)
-                time.sleep(4)
-
-                # 4) Cerca e clicca link
-                with page.expect_download(timeout=25000) as dl_info:
-                    if is_13ma:
-                        page.get_by_text(
-                            re.compile(f"Tredicesima.*{anno}", re.I)
-                        ).first.click()
-                    else:
-                        links = page.locator("a")
-                        total = links.count()
-                        found = False
-                        patterns = [
-                            f"{mese_nome} {anno}",
-                            f"{idx:02d}/{anno}",
-                            f"{idx:02d}-{anno}",
-                        ]
-                        for i in range(total):
-                            try:
-                                txt = (links.nth(i).inner_text() or "").strip()
-                                if not txt or len(txt) < 4:
-                                    continue
-                                if "Tredicesima" in txt or "13" in txt:
-                                    continue
-
-                                for pat in patterns:
-                                    if pat.lower() in txt.lower():
-                                        links.nth(i).click()
-                                        found = True
-                                        break
-                                if found:
-                                    break
-                            except:
-                                continue
 
-                        if not found:
-                            for i in range(total):
-                                try:
-                                    txt = links.nth(i).inner_text() or ""
-                                    if (
-                                        mese_nome.lower() in txt.lower()
-                                        and str(anno) in txt
-                                    ):
-                                        if "Tredicesima" not in txt:
-                                            links.nth(i).click()
-                                            found = True
-                                            break
-                                except:
-                                    continue
-
-                        if not found:
-                            raise Exception("Link busta non trovato")
-
-                dl_info.value.save_as(local_busta)
-                if os.path.exists(local_busta) and os.path.getsize(local_busta) > 1000:
-                    results["busta"] = local_busta
-                    st.toast(
-                        f"✅ Busta: {os.path.getsize(local_busta):,} bytes", icon="📄"
-                    )
+def execute_download(mese_nome, anno, user, pwd, is_13ma):
+    """
+    Scarica busta paga, cartellino e legge agenda.
+    I tre rami girano in parallelo su corsie diverse del pool, con la stessa
+    sessione: la latenza totale è quella del ramo più lento.
+    """
+    if mese_nome not in MESI_IT:
+        return {"busta": None, "cart": None, "agenda": None}
+
+    relay = ProgressRelay()
+    futures, timings, blocked = submit_download(
+        mese_nome, anno, user, pwd, is_13ma, relay
+    )
+    relay.wait(futures.values())
+    try:
+        results = collect_download(futures)
+    except LoginFailed:
+        st.error("❌ Login fallito")
+        results = {"busta": None, "cart": None, "agenda": None}
+    results["timings"] = timings
+    results["risorse"] = blocked
+    return results
 
-            except Exception as e:
-                st.warning(f"⚠️ Busta: {e}")
 
-            # === CARTELLINO ===
-            if not is_13ma:
-                st.toast("📅 Scarico Cartellino...", icon="📅")
-                try:
-                    # Torna home
-                    try:
-                        page.keyboard.press("Escape")
-                        time.sleep(0.3)
-                    except:
-                        pass
+def mesi_intervallo(modo, mese_nome, anno, n_mesi=12):
+    """
+    Mesi (nome, anno) da analizzare in modalità multi-mese, dal più vecchio.
+    "Anno intero" si ferma al mese corrente; "Ultimi N mesi" termina sul mese scelto.
+    """
+    oggi = time.localtime()
+    if modo == "Anno intero":
+        ultimo = 12 if anno < oggi.tm_year else oggi.tm_mon
+        return [(MESI_IT[i], anno) for i in range(ultimo)]
+
+    mesi = []
+    idx, y = MESI_IT.index(mese_nome), anno
+    for _ in range(n_mesi):
+        mesi.append((MESI_IT[idx], y))
+        idx -= 1
+        if idx < 0:
+            idx, y = 11, y - 1
+    return mesi[::-1]
+
+
+def analyze_range(mesi, user, pwd, relay):
+    """
+    Analisi multi-mese con un'unica sessione, a pipeline: tutti i download
+    vengono accodati subito sulle corsie del pool; appena i rami di un mese
+    sono pronti parte il parsing AI, e quando anche questo finisce il mese
+    viene restituito (generatore) già riconciliato, mentre gli altri proseguono.
+    Solo cedolini ordinari (niente tredicesima).
+    """
+    pending = set()
+    tags = {}  # future -> (fase, mese, chiave)
+    months = {}
+    for mese_nome, anno in mesi:
+        key = (mese_nome, anno)
+        futures, timings, blocked = submit_download(
+            mese_nome, anno, user, pwd, False, relay
+        )
+        months[key] = {"dl": futures, "timings": timings, "risorse": blocked, "ai": {}}
+        for branch, fut in futures.items():
+            tags[fut] = ("dl", key, branch)
+            pending.add(fut)
 
-                    try:
-                        logo = page.locator("img[src*='logo'], .logo").first
-                        if logo.is_visible(timeout=2000):
-                            logo.click()
-                            time.sleep(2)
-                    except:
-                        page.goto(
-                            "https://selfservice.gottardospa.it/js_rev/JSipert2",
-                            wait_until="domcontentloaded",
+    try:
+        while pending:
+            done, pending = wait_futures(
+                pending, timeout=0.2, return_when=FIRST_COMPLETED
+            )
+            relay.drain()
+            for fut in done:
+                fase, key, branch = tags.pop(fut)
+                m = months[key]
+
+                if fase == "dl":
+                    # Più rami dello stesso mese possono chiudersi nello stesso giro:
+                    # il parsing parte una volta sola
+                    if "paths" in m or any(not f.done() for f in m["dl"].values()):
+                        continue
+                    # Rami del mese pronti: download → parsing AI
+                    m["paths"] = collect_download(m["dl"])
+                    m["ai"] = {
+                        "busta": submit_ai(
+                            parse_busta_dettagliata, m["paths"]["busta"], relay
                         )
-                        time.sleep(3)
-
-                    # Time menu
-                    try:
-                        page.evaluate(
-                            "document.getElementById('revit_navigation_NavHoverItem_2_label')?.click()"
+                    }
+                    if m["paths"]["cart"]:
+                        m["ai"]["cart"] = submit_ai(
+                            parse_cartellino_dettagliato, m["paths"]["cart"], relay
                         )
-                    except:
-                        page.locator("text=Time").first.click(force=True)
-                    time.sleep(3)
+                    for branch_ai, f in m["ai"].items():
+                        tags[f] = ("ai", key, branch_ai)
+                        pending.add(f)
+                    continue
 
-                    # Tab Cartellino presenze
-                    try:
-                        page.evaluate(
-                            "document.getElementById('lnktab_5_label')?.click()"
-                        )
-                    except:
-                        page.locator("text=Cartellino").first.click(force=True)
-                    time.sleep(5)
-
-                    # Date
-                    last_day = calendar.monthrange(anno, idx)[1]
-                    d1, d2 = f"01/{idx:02d}/{anno}", f"{last_day}/{idx:02d}/{anno}"
-
-                    dal = page.locator(
-                        "input[id*='CLRICHIE'][class*='dijitInputInner']"
-                    ).first
-                    al = page.locator(
-                        "input[id*='CLRICHI2'][class*='dijitInputInner']"
-                    ).first
-
-                    if dal.count() > 0 and al.count() > 0:
-                        dal.click(force=True)
-                        page.keyboard.press("Control+A")
-                        dal.fill("")
-                        dal.type(d1, delay=80)
-                        dal.press("Tab")
-                        time.sleep(0.6)
-
-                        al.click(force=True)
-                        page.keyboard.press("Control+A")
-                        al.fill("")
-                        al.type(d2, delay=80)
-                        al.press("Tab")
-                        time.sleep(0.6)
-
-                    # Ricerca
-                    try:
-                        page.locator(
-                            "//span[contains(text(),'Esegui ricerca')]/ancestor::span[@role='button']"
-                        ).last.click(force=True)
-                    except:
-                        page.get_by_role(
-                            "button", name=re.compile("ricerca|esegui", re.I)
-                        ).last.click()
-                    time.sleep(8)
-
-                    # Icona PDF
-                    pattern_cart = f"{idx:02d}/{anno}"
-                    riga = page.locator(f"tr:has-text('{pattern_cart}')").first
-                    if (
-                        riga.count() > 0
-                        and riga.locator("img[src*='search']").count() > 0
-                    ):
-                        icona = riga.locator("img[src*='search']").first
-                    else:
-                        icona = page.locator("img[src*='search']").first
-
-                    if icona.count() > 0:
-                        with ctx.expect_page(timeout=20000) as popup_info:
-                            icona.click()
-                        popup = popup_info.value
-
-                        # Attendi URL PDF
-                        t0 = time.time()
-                        last_url = popup.url
-                        while time.time() - t0 < 15:
-                            u = popup.url
-                            if u and u != "about:blank":
-                                last_url = u
-                                if "SERVIZIO=JPSC" in u:
-                                    break
-                            time.sleep(0.25)
+                if m.get("yielded") or any(not f.done() for f in m["ai"].values()):
+                    continue
+                # Parsing pronto: riconciliazione e mese restituito alla UI
+                m["yielded"] = True
+                paths = m["paths"]
+                b = m["ai"]["busta"].result() or empty_busta()
+                c = m["ai"]["cart"].result() if "cart" in m["ai"] else {}
+                agenda = paths.get("agenda") or {}
+                yield {
+                    "busta": b,
+                    "cart": c,
+                    "agenda": agenda,
+                    "timings": m["timings"],
+                    "risorse": m["risorse"],
+                    "is_13": False,
+                    "mese": key[0],
+                    "anno": key[1],
+                    "riconciliazione": riconcilia_mese(b, c, agenda),
+                }
+    finally:
+        # Login fallito o esecuzione interrotta: libera le corsie dai job in coda
+        for fut in pending:
+            fut.cancel()
+        relay.drain()
 
-                        # Download PDF
-                        popup_url = last_url.replace("/js_rev//", "/js_rev/")
-                        if "EMBED" not in popup_url:
-                            popup_url += "&EMBED=y"
 
-                        resp = ctx.request.get(popup_url, timeout=60000)
-                        body = resp.body()
+# ==============================================================================
+# RICONCILIAZIONE MESE (BUSTA vs CARTELLINO vs AGENDA)
+# ==============================================================================
+def safe_float(val):
+    try:
+        if isinstance(val, str):
+            val = val.replace(",", ".")
+        return float(val)
+    except (ValueError, TypeError):
+        return 0.0
 
-                        if body[:4] == b"%PDF":
-                            with open(local_cart, "wb") as f:
-                                f.write(body)
-                            results["cart"] = local_cart
-                            st.toast(f"✅ Cartellino: {len(body):,} bytes", icon="📋")
-                        else:
-                            try:
-                                popup.pdf(path=local_cart, format="A4")
-                                if (
-                                    os.path.exists(local_cart)
-                                    and os.path.getsize(local_cart) > 5000
-                                ):
-                                    results["cart"] = local_cart
-                            except:
-                                pass
 
-                        try:
-                            popup.close()
-                        except:
-                            pass
+def riconcilia_mese(b, c, agenda):
+    """
+    Controllo incrociato dei GG INPS di un mese (cedolino ordinario).
+    Solo calcolo, nessun st.*: usato dalla vista del mese e dal riepilogo multi-mese.
+    """
+    c = c or {}
+    dg = b.get("dati_generali", {})
+    a_evs = agenda.get("events_by_type", {}) if isinstance(agenda, dict) else {}
 
-                except Exception as e:
-                    st.warning(f"⚠️ Cartellino: {e}")
+    # Dati dal cartellino (AI parsing)
+    c_lavorati = c.get("giorni_lavorati", 0)
+    c_festivita = c.get("festivita", 0)
+    c_malattia = c.get("malattia", 0)
+    c_ferie = c.get("ferie", 0)
+
+    # Dati dalla busta (ore ferie/permessi)
+    assenze_busta = b.get("assenze_mese", {})
+    ore_ferie_busta = safe_float(assenze_busta.get("ore_ferie", 0))
+    ore_permessi_busta = safe_float(assenze_busta.get("ore_permessi", 0))
+    ore_malattia_busta = safe_float(assenze_busta.get("ore_malattia", 0))
+
+    # Converti ore in giorni (ore totali / 7 per ottenere giorni)
+    ore_assenze_busta = ore_ferie_busta + ore_permessi_busta
+    gg_assenze_busta = round(ore_assenze_busta / 7) if ore_assenze_busta > 0 else 0
+    gg_malattia = round(ore_malattia_busta / 7) if ore_malattia_busta > 0 else c_malattia
+    gg_permessi = round(ore_permessi_busta / 7) if ore_permessi_busta > 0 else 0
+
+    # Dati dall'agenda (linee gialle = ferie reali)
+    a_ferie = a_evs.get("FERIE", 0)
+    a_omesse = a_evs.get("OMESSA TIMBRATURA", 0)
 
-        except Exception as e:
-            st.error(f"❌ Errore: {e}")
-        finally:
-            browser.close()
+    # PRIORITÀ FONTI SECONDO RICHIESTA UTENTE:
+    # 1. FERIE: Busta Paga (Documento Ufficiale) > Cartellino > Agenda
+    # 2. OMESSE: Solo Agenda (Dato informativo)
+    gg_ferie_effettive = 0
+    use_source_ferie = "Busta"
+    nota_ferie = None
+    if gg_assenze_busta > 0:
+        gg_ferie_effettive = gg_assenze_busta
+        # Info se c'è discrepanza con Cartellino
+        if c_ferie != gg_ferie_effettive:
+            nota_ferie = (
+                f"ℹ️ Ferie prese dalla Busta ({gg_ferie_effettive} gg) come da "
+                f"documento ufficiale (Cartellino indica {c_ferie})."
+            )
+    elif c_ferie > 0:
+        gg_ferie_effettive = c_ferie
+        use_source_ferie = "Cartellino"
+    elif a_ferie > 0:
+        gg_ferie_effettive = a_ferie
+        use_source_ferie = "Agenda"
+
+    # Omesse: SOLO dall'agenda, il cartellino non fa testo
+    final_omesse = a_omesse
+
+    # CALCOLO GG INPS: le omesse sono giorni LAVORATI, mai sommate alle assenze
+    gg_pagati_busta = dg.get("giorni_pagati", 0)  # GG. INPS dalla busta
+    tot_calcolato_base = c_lavorati + gg_ferie_effettive + gg_malattia + c_festivita
+    diff_base = tot_calcolato_base - gg_pagati_busta
+
+    # Se siamo in DIFETTO, proviamo a colmare usando le omesse come giorni lavorati
+    used_omesse = 0
+    tot_calcolato = tot_calcolato_base
+    diff_gg = diff_base
+    if gg_pagati_busta > 0 and diff_base < 0 and final_omesse > 0:
+        mancanti = int(round(abs(diff_base)))
+        used_omesse = min(int(final_omesse), mancanti)
+        tot_calcolato = tot_calcolato_base + used_omesse
+        diff_gg = tot_calcolato - gg_pagati_busta
+
+    if not gg_pagati_busta:
+        esito = "ℹ️ GG INPS n/d"
+    elif diff_gg == 0:
+        esito = "✅ Coerente"
+    elif abs(diff_gg) == 1:
+        esito = "✅ Quasi coerente"
+    elif diff_gg > 0:
+        esito = "⚠️ Eccesso"
+    else:
+        esito = "❌ Difetto"
+
+    return {
+        "c_lavorati": c_lavorati,
+        "c_riposi": c.get("riposi", 0),
+        "c_festivita": c_festivita,
+        "ore_ferie_busta": ore_ferie_busta,
+        "ore_permessi_busta": ore_permessi_busta,
+        "ore_assenze_busta": ore_assenze_busta,
+        "gg_assenze_busta": gg_assenze_busta,
+        "gg_malattia": gg_malattia,
+        "gg_permessi": gg_permessi,
+        "gg_ferie": gg_ferie_effettive,
+        "fonte_ferie": use_source_ferie,
+        "nota_ferie": nota_ferie,
+        "omesse": final_omesse,
+        "gg_inps": gg_pagati_busta,
+        "tot_base": tot_calcolato_base,
+        "tot": tot_calcolato,
+        "diff": diff_gg,
+        "omesse_usate": used_omesse,
+        "esito": esito,
+    }
 
-    return results
 
+# Codici agenda confrontabili con le categorie del cartellino (le omesse no:
+# per quelle il cartellino non fa testo)
+# Codici cartellino confrontabili con ciascun evento agenda. Per il riposo
+# solo i compensativi (RCS/RIC) che l'agenda registra: RCO/RDD/RPS sono i
+# riposi settimanali ordinari, assenti dall'agenda
+AGENDA_CART_CATEGORIES = {
+    "FERIE": CART_CATEGORIES["ferie"],
+    "MALATTIA": CART_CATEGORIES["malattia"],
+    "RIPOSO": {c for c, key in AGENDA_CODE_KEYS.items() if key == "RIPOSO"},
+}
 
-# ==============================================================================
-# PULIZIA FILE
-# ==============================================================================
-def cleanup_files(*paths):
-    deleted = []
-    for p in paths:
-        if p and os.path.exists(p):
-            try:
-                os.remove(p)
-                deleted.append(os.path.basename(p))
-            except:
-                pass
-    if deleted:
-        st.caption(f"🗑️ Eliminati: {', '.join(deleted)}")
+
+def diff_giorni_agenda(agenda, c):
+    """
+    Confronto giorno per giorno tra registro agenda e righe del cartellino.
+    Solo i giorni in cui le due fonti non concordano su ferie/malattia/riposo.
+    """
+    giorni_agenda = (agenda or {}).get("giorni") or {}
+    dettaglio = {g["giorno"]: g for g in (c or {}).get("giorni_dettaglio") or []}
+    if not giorni_agenda or not dettaglio:
+        return []
+
+    righe = []
+    for day in sorted(set(giorni_agenda) | set(dettaglio)):
+        codici = set((dettaglio.get(day) or {}).get("codici", []))
+        for code, cart_codes in AGENDA_CART_CATEGORIES.items():
+            in_agenda = code in giorni_agenda.get(day, {})
+            in_cart = bool(codici & cart_codes)
+            if in_agenda == in_cart:
+                continue
+            righe.append(
+                {
+                    "giorno": day,
+                    "evento": code,
+                    "agenda": "✔" if in_agenda else "—",
+                    "cartellino": ", ".join(sorted(codici)) if in_cart else "—",
+                    "fonti agenda": ", ".join(
+                        giorni_agenda.get(day, {}).get(code, {}).get("fonti", [])
+                    ),
+                }
+            )
+    return righe
+
+
+def riepilogo_periodo(risultati):
+    """Una riga per mese analizzato, in ordine cronologico."""
+    righe = []
+    for res in sorted(risultati, key=lambda r: (r["anno"], MESI_IT.index(r["mese"]))):
+        r = res["riconciliazione"]
+        netto = (res["busta"].get("dati_generali") or {}).get("netto", 0)
+        righe.append(
+            {
+                "mese": f"{res['mese']} {res['anno']}",
+                "GG INPS": r["gg_inps"],
+                "calcolati": r["tot"],
+                "diff": r["diff"],
+                "lavorati": r["c_lavorati"],
+                "ferie": r["gg_ferie"],
+                "omesse": r["omesse"],
+                "netto €": safe_float(netto),
+                "esito": r["esito"],
+            }
+        )
+    return righe
 
 
 # ==============================================================================
 # UI
 # ==============================================================================
 st.title("💶 Gottardo Payroll Analyzer")
+if CHROMIUM_SETUP["esito"] == "errore":
+    st.error("⚠️ Chromium non installato: dettagli in '⏱️ Tempi di avvio'.")
 
 # Credenziali
 u = st.session_state.get("u", st.secrets.get("ZK_USER", ""))
@@ -1547,44 +4202,117 @@ else:
     col_u.markdown(f"**👤 {u}**")
     m = col_m.selectbox("Mese", MESI_IT, index=9)  # Ottobre default
     a = col_a.selectbox("Anno", [2024, 2025, 2026], index=1)
+    modo = col_u.radio(
+        "Periodo", ["Mese singolo", "Anno intero", "Ultimi N mesi"], horizontal=True
+    )
+    n_mesi = 12
+    if modo == "Ultimi N mesi":
+        n_mesi = col_a.number_input("N mesi", min_value=2, max_value=24, value=6)
 
     tipo = "Cedolino"
-    if m == "Dicembre":
+    if m == "Dicembre" and modo == "Mese singolo":
         tipo = col_m.radio("Tipo", ["Cedolino", "Tredicesima"], horizontal=True)
 
-    if col_btn.button("🚀 ANALIZZA", type="primary"):
+    if modo != "Mese singolo" and col_btn.button("🚀 ANALIZZA PERIODO", type="primary"):
+        mesi = mesi_intervallo(modo, m, a, int(n_mesi))
+        st.session_state.pop("res", None)
+        st.session_state["batch"] = []
+        tabella = st.empty()
+
+        with st.status(f"🔄 Elaborazione di {len(mesi)} mesi...", expanded=True) as box:
+            relay = ProgressRelay()
+            try:
+                for res in analyze_range(mesi, u, pw, relay):
+                    st.session_state["batch"].append(res)
+                    st.write(f"✅ {res['mese']} {res['anno']} completato")
+                    tabella.table(riepilogo_periodo(st.session_state["batch"]))
+            except LoginFailed:
+                st.error("❌ Login fallito")
+            tabella.empty()  # Il riepilogo definitivo è nei risultati sotto
+            box.update(label="✅ Periodo analizzato", state="complete", expanded=False)
+
+    if modo == "Mese singolo" and col_btn.button("🚀 ANALIZZA", type="primary"):
+        st.session_state.pop("batch", None)
         is_13 = tipo == "Tredicesima"
 
         with st.status("🔄 Elaborazione...", expanded=True):
             # Download
             paths = execute_download(m, a, u, pw, is_13)
 
-            # Analisi AI
+            # Analisi AI: busta e cartellino in parallelo sul pool AI
             st.write("🧠 Analisi AI...")
-            res_b = parse_busta_dettagliata(paths["busta"])
-            res_c = (
-                parse_cartellino_dettagliato(paths["cart"])
+            relay = ProgressRelay()
+            fut_b = submit_ai(parse_busta_dettagliata, paths["busta"], relay)
+            fut_c = (
+                submit_ai(parse_cartellino_dettagliato, paths["cart"], relay)
                 if not is_13 and paths["cart"]
-                else {}
+                else None
             )
+            relay.wait([f for f in (fut_b, fut_c) if f])
+            res_b = fut_b.result()
+            res_c = fut_c.result() if fut_c else {}
 
             # Salva risultati
             st.session_state["res"] = {
                 "busta": res_b,
                 "cart": res_c,
-                "agenda": paths.get("agenda", {}),
+                "agenda": paths.get("agenda") or {},
+                "timings": paths.get("timings", []),
+                "risorse": paths.get("risorse", {}),
                 "is_13": is_13,
                 "mese": m,
                 "anno": a,
             }
 
-            # Pulizia
-            cleanup_files(paths.get("busta"), paths.get("cart"))
-
     if col_rst.button("🔄"):
         st.session_state.clear()
         st.rerun()
 
+    # Archivio locale cifrato: sincronizzazione dei soli cedolini nuovi/cambiati
+    archive = get_document_archive(u, pw)
+    if archive:
+        with st.sidebar.expander("🗄️ Archivio documenti"):
+            info = archive.summary()
+            st.caption(
+                f"{info['documenti']} documenti cifrati "
+                f"({info['byte'] / 1024:.0f} KB), conservati {ARCHIVE_RETENTION_DAYS} giorni"
+            )
+            if st.button("Sincronizza"):
+                relay = ProgressRelay()
+                fut = get_browser_pool().submit(
+                    u,
+                    pw,
+                    lambda ctx, page: sync_documenti(page, u, pw, StepWaiter(), relay),
+                    relay=relay,
+                )
+                relay.wait([fut])
+                try:
+                    stats = fut.result()
+                    st.success(
+                        f"✅ {stats['scaricati']} scaricati, "
+                        f"{stats['aggiornati']} già aggiornati"
+                    )
+                except LoginFailed:
+                    st.error("❌ Login fallito")
+    else:
+        st.sidebar.caption(
+            "🗄️ Archivio documenti spento (ARCHIVE_RETENTION_DAYS = 0 o cryptography mancante)"
+        )
+
+# ==============================================================================
+# RISULTATI MULTI-MESE
+# ==============================================================================
+if st.session_state.get("batch"):
+    batch = st.session_state["batch"]
+    st.markdown("---")
+    st.subheader(f"📆 Riepilogo periodo ({len(batch)} mesi)")
+    st.table(riepilogo_periodo(batch))
+
+    # Dettaglio completo di un mese con la stessa vista del mese singolo
+    etichette = [f"{r['mese']} {r['anno']}" for r in batch]
+    scelta = st.selectbox("🔎 Dettaglio mese", etichette, index=len(etichette) - 1)
+    st.session_state["res"] = batch[etichette.index(scelta)]
+
 # ==============================================================================
 # RISULTATI
 # ==============================================================================
@@ -1624,100 +4352,29 @@ if "res" in st.session_state:
         if not c:
             c = {}
 
-        # =====================================================================
-        # DATI DAL CARTELLINO (AI parsing)
-        # =====================================================================
-        c_lavorati = c.get("giorni_lavorati", 0)
-        c_ore_lavorate = c.get("ore_lavorate", 0)
-        c_omesse = c.get("omesse_timbrature", 0)
-        c_riposi = c.get("riposi", 0)
-        c_festivita = c.get("festivita", 0)
-        c_malattia = c.get("malattia", 0)
-
-        c_ferie = c.get("ferie", 0)
-
-        # =====================================================================
-        # DATI DALLA BUSTA (ore ferie/permessi)
-        # =====================================================================
-        assenze_busta = b.get("assenze_mese", {})
-        def safe_float(val):
-            try:
-                if isinstance(val, str):
-                    val = val.replace(",", ".")
-                return float(val)
-            except (ValueError, TypeError):
-                return 0.0
-
-        ore_ferie_busta = safe_float(assenze_busta.get("ore_ferie", 0))
-        ore_permessi_busta = safe_float(assenze_busta.get("ore_permessi", 0))
-        ore_malattia_busta = safe_float(assenze_busta.get("ore_malattia", 0))
-        
-        # Converti ore in giorni (ore totali / 7 per ottenere giorni)
-        ore_assenze_busta = ore_ferie_busta + ore_permessi_busta
-        gg_assenze_busta = round(ore_assenze_busta / 7) if ore_assenze_busta > 0 else 0
-        gg_malattia = round(ore_malattia_busta / 7) if ore_malattia_busta > 0 else c_malattia
-        gg_permessi = round(ore_permessi_busta / 7) if ore_permessi_busta > 0 else 0
-
-        # =====================================================================
-        # DATI DALL'AGENDA (FONTE PRIMARIA PER LE FERIE!)
-        # L'agenda mostra i giorni REALI di ferie (linee gialle)
-        # =====================================================================
-        a_ferie = a_evs.get("FERIE", 0)
-        a_omesse = a_evs.get("OMESSA TIMBRATURA", 0)
-        a_riposi = a_evs.get("RIPOSO", 0)
-        a_malattia = a_evs.get("MALATTIA", 0)
-
-        # PRIORITÀ FONTI SECONDO RICHIESTA UTENTE:
-        # 1. FERIE: Busta Paga (Documento Ufficiale)
-        # 2. OMESSE: Solo Agenda (Dato informativo)
-        
-        gg_ferie_effettive = 0
-        use_source_ferie = "Busta" # Label for UI
-
-        # Fix variabili usate nella UI (Tab Cartellino)
-        use_agenda = (use_source_ferie == "Agenda")
-        use_cartellino = (use_source_ferie == "Cartellino")
-
-        # LOGICA FERIE: Priorità Busta > Cartellino
-        if gg_assenze_busta > 0:
-            gg_ferie_effettive = gg_assenze_busta
-            # Info se c'è discrepanza con Cartellino
-            if c_ferie != gg_ferie_effettive:
-                 st.info(f"ℹ️ Ferie prese dalla Busta ({gg_ferie_effettive} gg) come da documento ufficiale (Cartellino indica {c_ferie}).")
-        elif c_ferie > 0:
-            gg_ferie_effettive = c_ferie
-            use_source_ferie = "Cartellino"
-        elif a_ferie > 0:
-            gg_ferie_effettive = a_ferie
-            use_source_ferie = "Agenda"
-
-        # =====================================================================
-        # CONSOLIDAMENTO OMESSE TIMBRATURE
-        # SOLO DALL'AGENDA. Il cartellino non fa testo per le omesse.
-        # =====================================================================
-        final_omesse = a_omesse
-
-        # =====================================================================
-        # CALCOLO GG INPS (VERIFICA PRINCIPALE)
-        # =====================================================================
-        gg_pagati_busta = dg.get("giorni_pagati", 0)  # GG. INPS dalla busta
-        
-        # TORNIAMO ALLA LOGICA PURA: CONTRONTO BUSTA vs CARTELLINO
-        # L'agenda è informativa, MA le OMESSE (solo agenda) sono giorni LAVORATI.
-        # Regola: le omesse NON sono assenze e NON vanno mai sommate alle ferie/permessi.
-
-        tot_calcolato_base = c_lavorati + gg_ferie_effettive + gg_malattia + c_festivita
-        diff_base = tot_calcolato_base - gg_pagati_busta
-
-        # Se siamo in DIFETTO, proviamo a colmare usando le omesse come giorni lavorati (subset di presenza).
-        used_omesse = 0
-        tot_calcolato = tot_calcolato_base
-        diff_gg = diff_base
-        if gg_pagati_busta > 0 and diff_base < 0 and final_omesse > 0:
-            mancanti = int(round(abs(diff_base)))
-            used_omesse = min(int(final_omesse), mancanti)
-            tot_calcolato = tot_calcolato_base + used_omesse
-            diff_gg = tot_calcolato - gg_pagati_busta
+        r = riconcilia_mese(b, c, agenda)
+        c_lavorati = r["c_lavorati"]
+        c_riposi = r["c_riposi"]
+        c_festivita = r["c_festivita"]
+        ore_ferie_busta = r["ore_ferie_busta"]
+        ore_permessi_busta = r["ore_permessi_busta"]
+        ore_assenze_busta = r["ore_assenze_busta"]
+        gg_assenze_busta = r["gg_assenze_busta"]
+        gg_malattia = r["gg_malattia"]
+        gg_permessi = r["gg_permessi"]
+        gg_ferie_effettive = r["gg_ferie"]
+        use_source_ferie = r["fonte_ferie"]
+        use_agenda = use_source_ferie == "Agenda"
+        use_cartellino = use_source_ferie == "Cartellino"
+        final_omesse = r["omesse"]
+        gg_pagati_busta = r["gg_inps"]
+        tot_calcolato_base = r["tot_base"]
+        tot_calcolato = r["tot"]
+        diff_gg = r["diff"]
+        used_omesse = r["omesse_usate"]
+
+        if r["nota_ferie"]:
+            st.info(r["nota_ferie"])
 
         # =====================================================================
         # VISUALIZZAZIONE RIEPILOGO
@@ -1914,6 +4571,17 @@ if "res" in st.session_state:
 
             if c.get("note"):
                 st.info(f"📝 {c['note']}")
+
+            # Confronto per giorno (serve il dettaglio righe del parser locale)
+            if agenda.get("giorni") and c.get("giorni_dettaglio"):
+                diff_giorni = diff_giorni_agenda(agenda, c)
+                with st.expander(
+                    f"🗓️ Agenda vs Cartellino giorno per giorno ({len(diff_giorni)} differenze)"
+                ):
+                    if diff_giorni:
+                        st.table(diff_giorni)
+                    else:
+                        st.success("✅ Ferie, malattia e riposi coincidono giorno per giorno")
         else:
             st.info(
                 "Cartellino non disponibile"
@@ -1943,3 +4611,55 @@ if "res" in st.session_state:
             p3, p4 = st.columns(2)
             p3.metric("Fruite", f"{safe_float_val(par.get('fruite', 0)):.2f}")
             p4.metric("Saldo", f"{safe_float_val(par.get('saldo', 0)):.2f}")
+
+    # === TEMPI PORTALE ===
+    timings = data.get("timings", [])
+    if timings:
+        tot_wait = sum(t["secondi"] for t in timings)
+        with st.expander(f"⏱️ Tempi attese portale ({tot_wait:.1f}s)"):
+            st.table(sorted(timings, key=lambda t: t["secondi"], reverse=True))
+            risorse = data.get("risorse") or {}
+            if risorse.get("richieste"):
+                st.caption(
+                    f"🚫 Profilo {RESOURCE_PROFILE}: {risorse['richieste']} richieste "
+                    f"bloccate, ~{risorse['byte'] / 1024:.0f} KB risparmiati (stima)"
+                )
+
+    # === STATO MODELLI AI ===
+    model_stats = get_model_router().snapshot()
+    if model_stats:
+        with st.expander("🤖 Stato modelli AI"):
+            st.table(model_stats)
+
+# ==============================================================================
+# TEMPI DI AVVIO
+# ==============================================================================
+STARTUP_TIMINGS["script completo"] = time.perf_counter() - STARTUP_T0
+with st.sidebar.expander("⏱️ Tempi di avvio"):
+    st.table(
+        [{"fase": k, "secondi": round(v, 3)} for k, v in STARTUP_TIMINGS.items()]
+    )
+    if STARTUP_TIMINGS["import moduli"] > IMPORT_BUDGET:
+        st.warning(
+            f"Import iniziali oltre il budget di {IMPORT_BUDGET:.1f}s: "
+            "controllare nuovi import in testa al file."
+        )
+    lazy = get_import_timings()
+    if lazy:
+        st.caption("Import differiti (primo uso nel processo):")
+        st.table(
+            [
+                {"modulo": k, "secondi": round(v, 3)}
+                for k, v in sorted(lazy.items(), key=lambda kv: -kv[1])
+            ]
+        )
+    if CHROMIUM_SETUP["esito"] == "installato":
+        st.caption(
+            f"Chromium installato una tantum in {CHROMIUM_SETUP['secondi']:.1f}s; "
+            "i rerun successivi saltano il controllo."
+        )
+    elif CHROMIUM_SETUP["esito"] == "errore":
+        st.error("Installazione Chromium fallita (nuovo tentativo al prossimo rerun):")
+        st.code(CHROMIUM_SETUP["errore"])
+    else:
+        st.caption("Chromium già provvisto (marker): nessun sottoprocesso.")